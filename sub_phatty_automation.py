@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty-automation
+
+Ramper och kurvor för CC-värden, schemalagda mot en monoton klocka. Varje
+steg har en deadline som räknas fram från starttiden (deadline += period),
+så att fördröjningar i ett steg inte förskjuter resten av rampen som en
+kedja av time.sleep gör.
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+
+from sub_phatty_midi import CC_STATUS, HiResControl, PRIORITY_SWEEP
+
+# Kurvor från 0.0 till 1.0 över rampens tid
+CURVES = {
+    'linear': lambda t: t,
+    'ease_in': lambda t: t * t,
+    'ease_out': lambda t: 1 - (1 - t) * (1 - t),
+    'ease_in_out': lambda t: t * t * (3 - 2 * t),
+    'exponential': lambda t: (2 ** (10 * t) - 1) / 1023
+}
+
+# Byte på bussen per steg, för bandbreddsbudgeten
+_BYTES_PER_CC = 3
+_BYTES_PER_HIRES = 6
+
+def check_duration(duration):
+    """Tiden i sekunder som float, kastar ValueError om den inte är ett ändligt tal >= 0"""
+    try:
+        duration = float(duration)
+    except (TypeError, ValueError):
+        raise ValueError(f"Ogiltig tid: {duration}")
+    # inf skulle aldrig bli klar och nan blir ett hopp direkt till målet
+    if not math.isfinite(duration) or duration < 0:
+        raise ValueError(f"Tiden måste vara ett ändligt tal >= 0, fick: {duration}")
+    return duration
+
+class AutomationJob:
+    """
+    En ramp för en CC (eller ett MSB/LSB-par med lsb_cc).
+
+    AutomationEngine använder key, value_at, message och cost, så andra
+    slags jobb (t.ex. MorphJob) kan ärva härifrån och byta ut dem.
+    """
+
+    def __init__(self, job_id, channel, cc, start, target, duration, curve, lsb_cc, description):
+        self.id = job_id
+        self.key = (channel, cc)
+        self.channel = channel
+        self.cc = cc
+        self.lsb_cc = lsb_cc
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.curve = CURVES[curve]
+        self.description = description
+
+        self.started = None
+        self.deadline = None
+        self.last_value = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+        # Statistik
+        self.steps = 0
+
+    def value_at(self, progress):
+        """Värdet vid progress (0.0-1.0)"""
+        if progress >= 1:
+            return self.target
+        return round(self.start + (self.target - self.start) * self.curve(progress))
+
+    def message(self, value):
+        if self.lsb_cc is None:
+            return (CC_STATUS[self.channel], self.cc, value)
+        return HiResControl(self.channel, self.cc, self.lsb_cc, value)
+
+    def cost(self, value):
+        """Byte på bussen för att skicka value"""
+        return _BYTES_PER_CC if self.lsb_cc is None else _BYTES_PER_HIRES
+
+    def wait(self, timeout=None):
+        """Vänta tills rampen är klar eller avbruten"""
+        return self.done.wait(timeout)
+
+class AutomationEngine:
+    """
+    Kör ramper i en egen tråd och lägger stegen i MIDI-skrivarens kö.
+
+    rate är antal steg per sekund för varje ramp. Steg som ger samma
+    CC-värde som förra skickas inte (gallring). budget är högsta antal byte
+    per sekund som automationen får använda på bussen (Sub Phattys länk
+    klarar ungefär 3125), None för obegränsat. Steg som inte ryms hoppas
+    över, nästa steg har ändå ett färskare värde. Slutvärdet skickas alltid.
+    """
+
+    def __init__(self, submit, rate=100, budget=None, on_finish=None):
+        if not (isinstance(rate, (int, float)) and math.isfinite(rate) and rate > 0):
+            raise ValueError(f"Ramphastigheten måste vara > 0 steg/s, fick: {rate}")
+        if budget is not None and not budget > 0:
+            raise ValueError(f"Bussbudgeten måste vara > 0 byte/s, fick: {budget}")
+        self.submit = submit          # submit(messages, priority, description)
+        self.period = 1.0 / rate
+        self.budget = budget
+        self.on_finish = on_finish    # on_finish(job)
+
+        self.heap = []                # (deadline, id, job)
+        self.jobs = {}                # (channel, cc) -> job
+        self.ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.running = True
+
+        # Bandbreddsbudget (token bucket), högst 50 ms i förväg
+        self.capacity = max(budget * 0.05, _BYTES_PER_HIRES) if budget else 0
+        self.tokens = self.capacity
+        self.refilled = time.monotonic()
+
+        # Statistik
+        self.sent = 0
+        self.thinned = 0
+        self.throttled = 0
+
+        self.thread = threading.Thread(target=self._run, name="automation", daemon=True)
+        self.thread.start()
+
+    def start(self, channel, cc, start, target, duration, curve='linear', lsb_cc=None,
+              description=""):
+        """
+        Starta en ramp från start till target på duration sekunder.
+
+        En ramp som redan går på samma CC avbryts. Med lsb_cc är värdena
+        14 bitar och skickas som MSB/LSB. Returnerar ett AutomationJob.
+        """
+        if curve not in CURVES:
+            raise ValueError(f"Okänd kurva: {curve} (giltiga: {', '.join(CURVES)})")
+        return self.schedule(AutomationJob(None, channel, cc, start, target, duration, curve,
+                                           lsb_cc, description))
+
+    def schedule(self, job):
+        """Starta ett färdigt jobb, ett annat jobb med samma key avbryts"""
+        job.duration = check_duration(job.duration)
+        with self.condition:
+            self._cancel_locked(job.key)
+            job.id = next(self.ids)
+            job.started = job.deadline = time.monotonic()
+            self.jobs[job.key] = job
+            heapq.heappush(self.heap, (job.deadline, job.id, job))
+            self.condition.notify()
+        return job
+
+    def cancel(self, channel, cc):
+        """Avbryt rampen på en CC (eller jobbet med key (channel, cc)), True om något gick"""
+        with self.condition:
+            return self._cancel_locked((channel, cc))
+
+    def cancel_all(self):
+        """Avbryt alla ramper"""
+        with self.condition:
+            for key in list(self.jobs):
+                self._cancel_locked(key)
+
+    def active(self):
+        """Ramper som pågår"""
+        with self.condition:
+            return list(self.jobs.values())
+
+    def close(self):
+        """Avbryt alla ramper och stoppa tråden"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.cancel_all()
+        self.thread.join(timeout=1)
+
+    def _cancel_locked(self, key):
+        job = self.jobs.pop(key, None)
+        if job is None:
+            return False
+        job.cancelled = True
+        job.done.set()
+        return True
+
+    def _next_job(self):
+        """Vänta på nästa deadline, None när tråden ska sluta"""
+        with self.condition:
+            while self.running:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.monotonic()
+                if delay <= 0:
+                    return heapq.heappop(self.heap)[2]
+                self.condition.wait(delay)
+            return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            now = time.monotonic()
+            if self._step(job, now):
+                self._finish(job)
+                continue
+
+            # Nästa deadline räknas från den förra, inte från nu. Har steg
+            # missats hoppar vi fram till nästa i samma raster.
+            job.deadline += self.period
+            if job.deadline <= now:
+                job.deadline += self.period * (int((now - job.deadline) / self.period) + 1)
+            with self.condition:
+                if not job.cancelled:
+                    heapq.heappush(self.heap, (job.deadline, job.id, job))
+
+    def _step(self, job, now):
+        """Skicka ett steg, returnerar True när rampen är klar"""
+        progress = (now - job.started) / job.duration if job.duration > 0 else 1.0
+        value = job.value_at(progress)
+        last = progress >= 1
+
+        if value == job.last_value:
+            self.thinned += 1
+            return last
+
+        if not self._take(job.cost(value), now):
+            self.throttled += 1
+            return False  # Även slutvärdet väntar på nästa steg
+
+        if job.cancelled:
+            return True
+        self.submit([job.message(value)], PRIORITY_SWEEP, None)
+        job.last_value = value
+        job.steps += 1
+        self.sent += 1
+        return last
+
+    def _take(self, cost, now):
+        """
+        Ta cost byte ur budgeten om de finns.
+
+        Ett steg som är större än hela hinken får gå när den är full, och
+        budgeten blir då negativ så att nästa steg väntar motsvarande tid.
+        """
+        if not self.budget:
+            return True
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.budget)
+        self.refilled = now
+        if self.tokens < min(cost, self.capacity):
+            return False
+        self.tokens -= cost
+        return True
+
+    def _finish(self, job):
+        with self.condition:
+            if self.jobs.get(job.key) is job:
+                del self.jobs[job.key]
+        job.done.set()
+        if self.on_finish and not job.cancelled:
+            self.on_finish(job)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty-enheter
+
+En eller flera synthar, var och en med egen port, kanal, ShadowState och
+skrivartråd. En ändring som ska till flera synthar läggs i varje enhets kö
+för sig, så en långsam USB-port håller inte upp de andra.
+"""
+
+from sub_phatty_automation import CURVES, AutomationEngine
+from sub_phatty_midi import (CCCoalescer, HiResControl, MidiOutputWorker, PortSupervisor,
+                             ShadowState, control_change, summarize_latencies,
+                             PRIORITY_PARAMETER, PRIORITY_SWEEP)
+from sub_phatty_morph import MORPH, MorphJob
+from sub_phatty_params import PARAMETERS_BY_CC
+from sub_phatty_patch import Patch, PatchRecall
+
+# Portnamn som känns igen som en Sub Phatty om inget annat anges
+DEFAULT_PATTERNS = ('Sub Phatty', 'Moog')
+
+# Grupp som alltid finns och innehåller alla enheter
+ALL_GROUP = 'all'
+
+def parse_device_spec(spec):
+    """
+    Tolka --device NAMN=PORT[@KANAL], t.ex. 'bas=Sub Phatty 2@3'.
+
+    PORT är en del av portnamnet och KANAL 1-16 (standard 2). Returnerar
+    (namn, mönster, kanal 0-15). Kastar ValueError om formatet är fel.
+    """
+    name, separator, rest = spec.partition('=')
+    name = name.strip()
+    if not separator or not name:
+        raise ValueError(f"Ogiltig enhet: {spec} (NAMN=PORT[@KANAL])")
+
+    pattern, at, channel = rest.rpartition('@')
+    if not at:
+        pattern, channel = rest, '2'
+    try:
+        channel = int(channel)
+    except ValueError:
+        raise ValueError(f"Ogiltig MIDI-kanal för {name}: {channel}")
+    if channel < 1 or channel > 16:
+        raise ValueError(f"MIDI-kanal för {name} måste vara 1-16, fick: {channel}")
+    if not pattern.strip():
+        raise ValueError(f"Portnamn saknas för {name}")
+    return name, pattern.strip(), channel - 1
+
+class SynthDevice:
+    """
+    En synth: port, kanal och egna trådar för sändning, portbevakning,
+    sammanslagning och ramper.
+
+    Värden som kommer hit är redan validerade av controllern.
+    """
+
+    def __init__(self, name, patterns=DEFAULT_PATTERNS, channel=1, coalesce_window=0.02,
+                 ramp_rate=100, bus_budget=2000, log=None, on_status=None):
+        self.name = name
+        self.patterns = tuple(patterns)
+        self.channel = channel
+        self.outport = None
+        self.prefix = ""                # "[namn] " i loggen när det finns flera
+        self.log_callback = log or (lambda message, *args: None)
+        self.on_status = on_status      # on_status(device)
+
+        # Senast skickade värden, samma värde skickas inte två gånger i rad
+        self.shadow = ShadowState()
+
+        # Porten ägs av en egen skrivartråd, under avbrott väntar kön
+        self.worker = MidiOutputWorker(on_sent=self._log_sent, on_error=self._log_send_error,
+                                       shadow=self.shadow, hold=True)
+        self.supervisor = PortSupervisor(self.worker, self.patterns, shadow=self.shadow,
+                                         on_change=self._port_changed, log=self.log)
+
+        # Slider-värden slås ihop så att bara det senaste skickas
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = CCCoalescer(self._send_coalesced, window=coalesce_window)
+
+        # Ramper mot en egen klocka, inom en bandbreddsbudget (byte/s)
+        self.automation = AutomationEngine(self.worker.submit, rate=ramp_rate,
+                                           budget=bus_budget or None,
+                                           on_finish=self._log_ramp_finished)
+
+    def log(self, message, *args):
+        """Logga med enhetens namn först när det finns flera enheter"""
+        if not args:
+            message = message.replace('%', '%%')
+        self.log_callback("%s" + message, self.prefix, *args)
+
+    def start(self):
+        """Leta upp porten och börja bevaka den"""
+        self.supervisor.start()
+
+    def close(self):
+        """Skicka det som väntar och stäng porten"""
+        self.automation.close()
+        if self.coalescer:
+            self.coalescer.close()
+        self.worker.close()
+        self.supervisor.close()
+
+    def is_connected(self):
+        """Är porten öppen?"""
+        return self.outport is not None
+
+    def can_send(self):
+        """Finns en port (även under ett kort avbrott, då väntar kön)?"""
+        return self.supervisor.port_name is not None
+
+    def connect(self):
+        """Sök efter porten igen och anslut"""
+        connected = self.supervisor.connect(rescan=True)
+        if not connected:
+            self.log("✗ Ingen Sub Phatty hittades")
+            self._notify()
+        return connected
+
+    def status(self):
+        """Status för /status"""
+        return {
+            'connected': self.is_connected(),
+            'port': self.supervisor.port_name,
+            'channel': self.channel + 1,
+            'pending': self.worker.pending(),
+            'suppressed': self.shadow.suppressed,
+            'ramps': len(self.automation.active())
+        }
+
+    def stats(self):
+        """Räknare för /stats (sedan start) och fördröjning från kö till port"""
+        return {
+            'sent': self.worker.sent,
+            'errors': self.worker.errors,
+            'pending': self.worker.pending(),
+            'suppressed': self.shadow.suppressed,
+            'reconnects': self.supervisor.reconnects,
+            'ramp_steps': self.automation.sent,
+            'ramp_thinned': self.automation.thinned,
+            'ramp_throttled': self.automation.throttled,
+            'submitted': self.coalescer.submitted if self.coalescer else 0,
+            'coalesced': self.coalescer.coalesced if self.coalescer else 0,
+            'latency_ms': summarize_latencies(list(self.worker.latencies))
+        }
+
+    def send_cc(self, cc_number, value, description="", coalesce=False, force=False,
+                hires=False):
+        """
+        Skicka CC-meddelande (se SubPhattyWebController.send_cc).
+
+        Med hires är value 0-16383 och cc_number parameterns MSB.
+        """
+        if not self.can_send():
+            self.log("✗ Ingen MIDI-anslutning")
+            return False
+
+        # Ett värde satt för hand vinner över en pågående ramp
+        self.automation.cancel(self.channel, cc_number)
+
+        if coalesce and self.coalescer and not force:
+            self.coalescer.submit(self.channel, cc_number, value, description, hires)
+            return True
+        self._send_cc(self.channel, cc_number, value, description, force=force, hires=hires)
+        return True
+
+    def send_batch(self, resolved, force=False):
+        """
+        Skicka validerade ändringar [(cc, värde, beskrivning, hires), ...].
+
+        Allt läggs som en post i skrivartrådens kö, så inga andra meddelanden
+        hamnar mitt i skuren.
+        """
+        if not self.can_send():
+            self.log("✗ Ingen MIDI-anslutning")
+            return False
+
+        messages = []
+        descriptions = {}
+        for cc_number, value, description, hires in resolved:
+            if hires:
+                cc_lsb = PARAMETERS_BY_CC[cc_number].cc_lsb
+                messages.append(HiResControl(self.channel, cc_number, cc_lsb, value))
+                descriptions[cc_lsb] = description
+            else:
+                messages.append(control_change(self.channel, cc_number, value))
+            descriptions[cc_number] = description
+        self.worker.submit(messages, PRIORITY_PARAMETER, descriptions, force=force)
+        return True
+
+    def recall(self, patch, description="", force=False):
+        """
+        Skicka en hel patch som en skur, bara de CC:er som skiljer sig från
+        det som senast skickades (alla satta värden med force).
+
+        Returnerar ungefär hur många CC:er som går ut. Den exakta skillnaden
+        räknas av skrivartråden vid sändning, se PatchRecall.
+        """
+        if not self.can_send():
+            self.log("✗ Ingen MIDI-anslutning")
+            return None
+
+        # Ramper, morfer och väntande slider-värden skulle skriva över patchen
+        ccs = [parameter.cc_msb for parameter, _ in patch.items()]
+        for cc_number in ccs:
+            self.automation.cancel(self.channel, cc_number)
+        self.automation.cancel(self.channel, MORPH)
+        if self.coalescer:
+            self.coalescer.discard(self.channel, ccs)
+
+        # Samma prioritet som svep, så att slider-värden som redan ligger i
+        # kön skickas före patchen och inte efter
+        changes = len(patch.set_indices()) if force else len(self.patch().changes(patch))
+        self.worker.submit([PatchRecall(self.channel, patch)], PRIORITY_SWEEP, description,
+                           force=force)
+        return changes
+
+    def morph_to(self, frame):
+        """
+        Skicka en morfbild (se Morph.frame). Bara CC:er som ändrats sedan
+        förra bilden går ut, och bilderna loggas inte var för sig.
+        """
+        if not self.can_send():
+            self.log("✗ Ingen MIDI-anslutning")
+            return False
+        self.automation.cancel(self.channel, MORPH)
+        self.worker.submit([PatchRecall(self.channel, frame)], PRIORITY_SWEEP, None)
+        return True
+
+    def start_morph(self, morph, duration, curve='linear', description=""):
+        """Morfa över duration sekunder, kastar ValueError för ogiltig kurva eller tid"""
+        if curve not in CURVES:
+            raise ValueError(f"Okänd kurva: {curve} (giltiga: {', '.join(CURVES)})")
+        return self.automation.schedule(MorphJob(self.channel, morph, duration, curve,
+                                                 description))
+
+    def cancel_morph(self):
+        """Avbryt en pågående morf, True om någon gick"""
+        return self.automation.cancel(self.channel, MORPH)
+
+    def current_value(self, spec, hires=False):
+        """Senast skickade värde för en parameter, None om okänt"""
+        msb = self.shadow.get(self.channel, spec.cc_msb)
+        if msb is None or not hires:
+            return msb
+        lsb = self.shadow.get(self.channel, spec.cc_lsb)
+        return (msb << 7) | (lsb or 0)
+
+    def patch(self):
+        """Senast skickade värden för alla parametrar som en Patch"""
+        return Patch.from_shadow(self.shadow, self.channel)
+
+    def ramp(self, spec, start, target, duration, curve='linear', hires=False):
+        """
+        Starta en ramp för en parameter, start None = senast skickade värde.
+
+        Returnerar startvärdet, kastar ValueError för ogiltig kurva eller tid.
+        """
+        if start is None:
+            start = self.current_value(spec, hires)
+            if start is None:
+                start = target  # Okänt läge, hoppa direkt till målet
+        self.automation.start(self.channel, spec.cc_msb, start, target, duration, curve,
+                              lsb_cc=spec.cc_lsb if hires else None, description=spec.name)
+        return start
+
+    def cancel_ramp(self, spec):
+        """Avbryt rampen för en parameter, True om någon gick"""
+        return self.automation.cancel(self.channel, spec.cc_msb)
+
+    def _send_coalesced(self, channel, cc_number, value, description, hires, queued_at):
+        """Anropas från sammanslagningstråden"""
+        self._send_cc(channel, cc_number, value, description, priority=PRIORITY_SWEEP,
+                      hires=hires, queued_at=queued_at)
+
+    def _send_cc(self, channel, cc_number, value, description, priority=PRIORITY_PARAMETER,
+                 force=False, hires=False, queued_at=None):
+        """Lägg CC-meddelandet i skrivartrådens kö"""
+        # Rå tupel i stället för mido.Message, värdet är redan validerat
+        if hires:
+            message = HiResControl(channel, cc_number, PARAMETERS_BY_CC[cc_number].cc_lsb, value)
+        else:
+            message = control_change(channel, cc_number, value)
+        self.worker.submit([message], priority, description, force=force, queued_at=queued_at)
+
+    def _port_changed(self, port, name):
+        """Anropas av PortSupervisor när porten öppnas eller försvinner"""
+        self.outport = port
+        self._notify()
+
+    def _notify(self):
+        if self.on_status:
+            self.on_status(self)
+
+    def _log_sent(self, messages, description):
+        """
+        Anropas från skrivartråden när meddelanden har skickats.
+
+        För en batch är description en dict {cc: beskrivning}, så att bara
+        de CC:er som faktiskt skickades (inte redan hade värdet) loggas.
+        Rampsteg har ingen beskrivning och loggas bara när rampen är klar.
+        """
+        if description is None:
+            return
+        if isinstance(description, dict):
+            sent = ", ".join(f"{description.get(cc_number, '')} (CC#{cc_number}={value})"
+                             for _, cc_number, value in messages)
+            self.log("✓ Batch med %d parametrar: %s", len(messages), sent)
+        elif len(messages) == 1:
+            _, cc_number, value = messages[0]
+            self.log("✓ %s (CC#%d=%d)", description, cc_number, value)
+        else:
+            # 14-bitars värde, MSB och LSB
+            self.log("✓ %s (%s)", description,
+                     ", ".join(f"CC#{cc_number}={value}" for _, cc_number, value in messages))
+
+    def _log_send_error(self, error, description):
+        """Anropas från skrivartråden när porten felar"""
+        if isinstance(description, dict):
+            description = ", ".join(description.values())
+        elif description is None:
+            description = "ramp"
+        self.log("✗ Fel vid sändning av %s: %s", description, error)
+
+    def _log_ramp_finished(self, job):
+        """Anropas från automationstråden när en ramp har nått målet"""
+        if isinstance(job, MorphJob):
+            self.log("✓ Morf klar: %s (%d steg)", job.description, job.steps)
+            return
+        self.log("✓ Ramp klar: %s = %d (%d steg)", job.description, job.target, job.steps)
+
+class DeviceRegistry:
+    """
+    Alla enheter och grupper av enheter.
+
+    Den första enheten är standard när en förfrågan inte anger någon.
+    Gruppen 'all' innehåller alltid alla enheter.
+    """
+
+    def __init__(self):
+        self.devices = {}       # namn -> SynthDevice, i den ordning de lades till
+        self.groups = {}        # namn -> [namn, ...]
+
+    def add(self, device):
+        """Lägg till en enhet"""
+        if device.name in self.devices or device.name == ALL_GROUP:
+            raise ValueError(f"Enheten finns redan: {device.name}")
+        self.devices[device.name] = device
+
+        # Med flera enheter får loggraderna enhetens namn först
+        several = len(self.devices) > 1
+        for each in self.devices.values():
+            each.prefix = f"[{each.name}] " if several else ""
+        return device
+
+    def add_group(self, name, device_names):
+        """Lägg till en grupp, kastar ValueError för okända enheter"""
+        if name in self.devices or name == ALL_GROUP:
+            raise ValueError(f"Gruppnamnet är upptaget: {name}")
+        for device_name in device_names:
+            if device_name not in self.devices:
+                raise ValueError(f"Okänd enhet i grupp {name}: {device_name}")
+        self.groups[name] = list(device_names)
+
+    @property
+    def default(self):
+        """Första enheten"""
+        return next(iter(self.devices.values()))
+
+    def resolve(self, target=None):
+        """
+        Enheterna för en förfrågan: None = standardenheten, annars namnet på
+        en enhet eller en grupp. Kastar ValueError för okända namn.
+        """
+        if not target:
+            return [self.default]
+        if target in self.devices:
+            return [self.devices[target]]
+        if target == ALL_GROUP:
+            return list(self.devices.values())
+        if target in self.groups:
+            return [self.devices[name] for name in self.groups[target]]
+        raise ValueError(f"Okänd enhet eller grupp: {target}")
+
+    def start(self):
+        for device in self.devices.values():
+            device.start()
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def __len__(self):
+        return len(self.devices)
@@ -10,6 +10,10 @@ import mido
 import sys
 import time
 
+from sub_phatty_log import LogWriter
+from sub_phatty_presets import PresetLibrary
+from sub_phatty_virtual import VirtualSubPhatty
+
 class SubPhattySimpleController:
     def __init__(self):
         self.outport = None
@@ -38,8 +42,18 @@ class SubPhattySimpleController:
             '2': 64      # 2'
         }
         
-    def connect(self):
-        """Anslut till Sub Phatty"""
+        # Utskrifter från sändningen görs av en bakgrundstråd så att en
+        # långsam terminal inte fördröjer MIDI
+        self.logger = LogWriter(timestamps=False)
+        
+    def connect(self, virtual=False):
+        """Anslut till Sub Phatty (eller en emulerad med virtual)"""
+        if virtual:
+            synth = VirtualSubPhatty(self.midi_channel)
+            self.outport = synth.open_output()
+            print(f"✓ Ansluten till: {synth.name}")
+            return True
+        
         output_ports = mido.get_output_names()
         
         for port in output_ports:
@@ -57,7 +71,7 @@ class SubPhattySimpleController:
     def send_cc(self, cc_number, value, description=""):
         """Skicka CC-meddelande"""
         if not self.outport:
-            print("✗ Ingen MIDI-anslutning")
+            self.logger.emit("✗ Ingen MIDI-anslutning")
             return False
             
         try:
@@ -66,10 +80,10 @@ class SubPhattySimpleController:
                              control=cc_number,
                              value=value)
             self.outport.send(msg)
-            print(f"✓ Skickat: {description} (CC#{cc_number}={value})")
+            self.logger.emit("✓ Skickat: %s (CC#%d=%d)", description, cc_number, value)
             return True
         except Exception as e:
-            print(f"✗ Fel vid sändning: {e}")
+            self.logger.emit("✗ Fel vid sändning: %s", e)
             return False
     
     def set_lfo_wave(self, wave):
@@ -94,18 +108,50 @@ class SubPhattySimpleController:
         value = self.vco_values[octave]
         return self.send_cc(self.vco_cc, value, f"VCO Octave: {octave}'")
     
+    def load_preset(self, name):
+        """Skicka alla värden i en preset (utan ShadowState vet vi inte vad synthen har)"""
+        presets = PresetLibrary()
+        try:
+            patch = presets.get(name)
+        except ValueError as e:
+            print(f"✗ {e}")
+            return False
+        finally:
+            presets.close()
+        
+        if not self.outport:
+            self.logger.emit("✗ Ingen MIDI-anslutning")
+            return False
+        try:
+            items = patch.items()
+            for parameter, value in items:
+                self.outport.send(mido.Message('control_change',
+                                               channel=self.midi_channel,
+                                               control=parameter.cc_msb,
+                                               value=value))
+            self.logger.emit("✓ Skickat: Preset %s (%d parametrar)", name, len(items))
+            return True
+        except Exception as e:
+            self.logger.emit("✗ Fel vid sändning: %s", e)
+            return False
+    
     def interactive_mode(self):
         """Interaktivt läge"""
         print("\n=== Sub Phatty Kontroller ===")
         print("Kommandon:")
         print("  lfo triangle|square|saw|ramp|sample_hold|filter_env")
         print("  vco 16|8|4|2") 
+        print("  preset <namn>")
+        print("  presets")
         print("  quit")
         print()
         
         while True:
             try:
-                cmd = input("sub-phatty> ").strip().lower()
+                # Låt loggen skrivas klart innan prompten visas
+                self.logger.flush()
+                line = input("sub-phatty> ").strip()
+                cmd = line.lower()
                 
                 if cmd == 'quit' or cmd == 'exit':
                     break
@@ -115,10 +161,17 @@ class SubPhattySimpleController:
                 elif cmd.startswith('vco '):
                     octave = cmd[4:]
                     self.set_vco_octave(octave)
+                elif cmd.startswith('preset '):
+                    # Namnet med versaler som det skrevs
+                    self.load_preset(line[7:].strip())
+                elif cmd == 'presets':
+                    show_presets()
                 elif cmd == 'help':
                     print("Kommandon:")
                     print("  lfo triangle|square|saw|ramp|sample_hold|filter_env")
                     print("  vco 16|8|4|2")
+                    print("  preset <namn>")
+                    print("  presets")
                     print("  quit")
                 elif cmd == '':
                     continue
@@ -133,10 +186,21 @@ class SubPhattySimpleController:
     
     def close(self):
         """Stäng MIDI-anslutning"""
+        self.logger.close()
         if self.outport:
             self.outport.close()
             print("✓ MIDI-anslutning stängd")
 
+def show_presets():
+    """Lista sparade presets (sparas från webbgränssnittet)"""
+    presets = PresetLibrary()
+    names = presets.names()
+    presets.close()
+    if not names:
+        print("Inga sparade presets")
+    for name in names:
+        print(f"  {name}")
+
 def show_help():
     """Visa hjälptext"""
     print("""
@@ -147,6 +211,9 @@ ANVÄNDNING:
   python3 sub_phatty_final.py lfo triangle       # Sätt LFO till triangle
   python3 sub_phatty_final.py vco 8              # Sätt VCO till 8'
   python3 sub_phatty_final.py help               # Visa denna hjälp
+  python3 sub_phatty_final.py preset lead        # Ladda preset 'lead'
+  python3 sub_phatty_final.py presets            # Lista presets
+  python3 sub_phatty_final.py --virtual ...      # Kör mot en emulerad synth
 
 LFO VÅGOR:
   triangle, square, saw, ramp, sample_hold, filter_env
@@ -167,26 +234,38 @@ OBSERVERA:
 def main():
     """Huvudfunktion"""
     
-    if len(sys.argv) > 1 and sys.argv[1] in ['help', '-h', '--help']:
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] in ['help', '-h', '--help']:
         show_help()
         return
     
+    # --virtual kan stå var som helst på raden
+    virtual = '--virtual' in args
+    args = [arg for arg in args if arg != '--virtual']
+    
+    if args == ['presets']:
+        show_presets()
+        return 0
+    
     controller = SubPhattySimpleController()
     
     # Anslut
-    if not controller.connect():
+    if not controller.connect(virtual=virtual):
         return 1
     
     try:
         # Kommandoradsanvändning
-        if len(sys.argv) >= 3:
-            cmd = sys.argv[1].lower()
-            param = sys.argv[2].lower()
+        if len(args) >= 2:
+            cmd = args[0].lower()
+            param = args[1].lower()
             
             if cmd == 'lfo':
                 controller.set_lfo_wave(param)
             elif cmd == 'vco':
                 controller.set_vco_octave(param)
+            elif cmd == 'preset':
+                if not controller.load_preset(' '.join(args[1:])):
+                    return 1
             else:
                 print(f"✗ Okänt kommando: {cmd}")
                 print("Använd 'help' för instruktioner")
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty-logg
+
+Loggbuffert för web-controllern och en skrivartråd för terminalen.
+Flera HTTP-trådar skriver och läser samtidigt, så bufferten har ett eget
+lås. Poster lagras oformaterade och formateras först när någon läser dem.
+"""
+
+import queue
+import sys
+import threading
+import time
+
+class LogRingBuffer:
+    """
+    Ringbuffert med fast storlek och sekvensnummer.
+
+    Varje rad får ett stigande sekvensnummer. append är O(1) och allokerar
+    ingen ny lista, äldsta raden skrivs helt enkelt över. Läsare hämtar bara
+    raderna efter ett visst sekvensnummer i stället för hela historiken.
+
+    lock är en RLock som även anroparen kan hålla runt sammansatta
+    operationer (t.ex. lägga till en rad och meddela prenumeranter).
+    """
+
+    def __init__(self, capacity=50):
+        if capacity < 1:
+            raise ValueError("Kapaciteten måste vara minst 1")
+        self.capacity = capacity
+        self.entries = [None] * capacity
+        self.seq = 0          # sekvensnummer för senaste raden
+        self.first_seq = 1    # äldsta sekvensnummer som finns kvar
+        self.lock = threading.RLock()
+
+    def append(self, entry):
+        """Lägg till en rad, returnerar dess sekvensnummer"""
+        with self.lock:
+            self.seq += 1
+            self.entries[self.seq % self.capacity] = entry
+            if self.seq - self.first_seq >= self.capacity:
+                self.first_seq = self.seq - self.capacity + 1
+            return self.seq
+
+    def since(self, since=None):
+        """
+        Hämta rader nyare än sekvensnumret since.
+
+        Returnerar (rader, senaste sekvensnummer, reset). reset är True när
+        läsaren ska ersätta allt den har: since saknas, är från en tidigare
+        körning (större än seq) eller så har rader hunnit skrivas över.
+        """
+        with self.lock:
+            if since is None or since > self.seq or since < self.first_seq - 1:
+                start = self.first_seq
+                reset = True
+            else:
+                start = since + 1
+                reset = False
+            entries = [self.entries[seq % self.capacity] for seq in range(start, self.seq + 1)]
+            return entries, self.seq, reset
+
+    def snapshot(self):
+        """Alla rader som finns kvar, äldst först"""
+        return self.since(None)[0]
+
+    def clear(self):
+        """Töm bufferten, sekvensnumren fortsätter där de var"""
+        with self.lock:
+            self.entries = [None] * self.capacity
+            self.first_seq = self.seq + 1
+
+    def __len__(self):
+        with self.lock:
+            return self.seq - self.first_seq + 1
+
+def format_record(record, timestamps=True):
+    """
+    Formatera en loggpost (tidpunkt, meddelande, argument) till en rad.
+
+    Meddelandet är en %-formatsträng. Utan argument används det som det är,
+    så att rader med '%' i sig inte går sönder.
+    """
+    timestamp, message, args = record
+    text = message % args if args else message
+    if timestamps:
+        return f"[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] {text}"
+    return text
+
+class LogWriter:
+    """
+    Skriver loggposter till terminalen från en bakgrundstråd.
+
+    På sändningsvägen läggs bara en tupel i en kö. Formatering och utskrift
+    sker i skrivartråden, så en långsam eller pausad terminal bromsar inte
+    MIDI-utskicken.
+    """
+
+    def __init__(self, stream=None, timestamps=True):
+        self.stream = stream or sys.stdout
+        self.timestamps = timestamps
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        """Lägg en färdig post (tidpunkt, meddelande, argument) i kön"""
+        self.records.put(record)
+
+    def emit(self, message, *args):
+        """Lägg ett meddelande i kön med aktuell tid"""
+        self.records.put((time.time(), message, args))
+
+    def flush(self, timeout=1.0):
+        """Vänta tills allt som ligger i kön är utskrivet"""
+        done = threading.Event()
+        self.records.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        """Skriv ut det som är kvar och stoppa tråden"""
+        self.records.put(None)
+        self.thread.join(timeout=1.0)
+
+    def _output(self, lines):
+        if not lines:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass  # Terminalen är borta, loggen finns kvar i bufferten
+
+    def _run(self):
+        while True:
+            item = self.records.get()
+            lines = []
+
+            # Ta allt som väntar och skriv det i ett svep
+            while True:
+                if item is None:
+                    self._output(lines)
+                    return
+                elif isinstance(item, threading.Event):
+                    self._output(lines)
+                    lines = []
+                    item.set()
+                else:
+                    lines.append(format_record(item, self.timestamps))
+
+                try:
+                    item = self.records.get_nowait()
+                except queue.Empty:
+                    break
+
+            self._output(lines)
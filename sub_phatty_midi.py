@@ -0,0 +1,641 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty MIDI-utgång
+
+Byggstenar mellan controllern och MIDI-porten. Länken till Sub Phatty går
+i 31.25 kbaud, så allt som skickas i onödan märks som fördröjning.
+"""
+
+import itertools
+import queue
+import threading
+import time
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+import mido
+
+from sub_phatty_params import PARAMETERS
+
+# Prioriteter för MidiOutputWorker, lägre värde skickas först
+PRIORITY_REALTIME = 0     # klocka, start/stopp
+PRIORITY_NOTE = 1         # noter
+PRIORITY_PARAMETER = 2    # knapptryck och enstaka parameterändringar
+PRIORITY_SWEEP = 3        # slider-svep och automation
+
+# Används för att stoppa tråden efter allt annat i kön
+_PRIORITY_STOP = 99
+
+# Antal fördröjningar (kö till port) som MidiOutputWorker sparar för statistik
+LATENCY_SAMPLES = 4096
+
+# Värde i ShadowState för CC:er som aldrig skickats (giltiga värden är 0-127)
+UNKNOWN = 0xFF
+
+# LSB-CC för parametrar med 14 bitar, per MSB-CC. En mottagare får nollställa
+# LSB när MSB kommer, så ett ensamt MSB gör LSB okänd i ShadowState.
+LSB_FOR_MSB = {parameter.cc_msb: parameter.cc_lsb for parameter in PARAMETERS
+               if parameter.cc_lsb is not None}
+
+# Statusbyte för Control Change per kanal (0xB0 | kanal), beräknade en gång
+CC_STATUS = tuple(0xB0 | channel for channel in range(16))
+
+def control_change(channel, cc, value):
+    """
+    Rått CC-meddelande (status, cc, värde).
+
+    Billigare än mido.Message, som byggs och valideras för att sedan bli
+    samma tre byte. Anroparen ansvarar för att värdena är giltiga.
+    """
+    return (CC_STATUS[channel], cc, value)
+
+# 14-bitars CC, delas upp i MSB och LSB av MidiOutputWorker vid sändning
+HiResControl = namedtuple('HiResControl', ['channel', 'msb_cc', 'lsb_cc', 'value'])
+
+def split_14bit(value):
+    """0-16383 -> (MSB, LSB)"""
+    return value >> 7, value & 0x7F
+
+def summarize_latencies(samples):
+    """Antal, median, 99:e percentil och max i ms för fördröjningar i sekunder"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0, 'p50': None, 'p99': None, 'max': None}
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+    return {'count': len(ordered), 'p50': at(0.50), 'p99': at(0.99),
+            'max': round(ordered[-1] * 1000, 3)}
+
+def cc_fields(message):
+    """(kanal, cc, värde) för ett CC-meddelande, rått eller mido, annars None"""
+    if type(message) is tuple:
+        if message[0] & 0xF0 == 0xB0:
+            return message[0] & 0x0F, message[1], message[2]
+        return None
+    if message.type == 'control_change':
+        return message.channel, message.control, message.value
+    return None
+
+class RunningStatusEncoder:
+    """
+    Packar råa kanalmeddelanden till en byteström med running status.
+
+    Statusbytet utelämnas när det är samma som föregående meddelandes, så
+    en skur CC på samma kanal blir 2 byte per meddelande i stället för 3.
+    Gäller bara byteströmmar (DIN-MIDI, seriellt). USB-MIDI skickar alltid
+    hela paket och rtmidi tar ett meddelande i taget.
+    """
+
+    def __init__(self):
+        self.status = None
+
+    def encode(self, messages):
+        """Koda en skur råa meddelanden, returnerar bytes"""
+        out = bytearray()
+        status = self.status
+        for message in messages:
+            first = message[0]
+            if first >= 0xF8:
+                out.append(first)  # Realtid påverkar inte running status
+                continue
+            if first != status:
+                out.append(first)
+            out.extend(message[1:])
+            status = first if first < 0xF0 else None
+        self.status = status
+        return bytes(out)
+
+    def reset(self):
+        """Nästa meddelande får alltid statusbyte (t.ex. efter ett avbrott)"""
+        self.status = None
+
+class RawMidiOutput:
+    """
+    Skickar råa meddelanden till en port utan att gå via mido.Message.
+
+    För mido:s rtmidi-portar går bytena direkt till python-rtmidi, förbi
+    portens eget lås (MidiOutputWorker är ensam om porten). Portar som tar
+    en byteström (write_bytes) får skurar med running status. Övriga portar
+    får ett mido.Message byggt från bytena. mido.Message fungerar överallt.
+
+    _rt är privat i mido, så vägen väljs när porten öppnas: saknas
+    _rt.send_message (annan backend eller mido-version) används port.send.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.encoder = None
+        send_message = getattr(getattr(port, '_rt', None), 'send_message', None)
+        if callable(send_message):
+            self.send_bytes = send_message
+        elif hasattr(port, 'write_bytes'):
+            self.send_bytes = port.write_bytes
+            self.encoder = RunningStatusEncoder()
+        else:
+            self.send_bytes = self._send_via_mido
+
+    def _send_via_mido(self, data):
+        self.port.send(mido.Message.from_bytes(data))
+
+    def send(self, message):
+        """Skicka ett meddelande, rått (tupel) eller mido.Message"""
+        if type(message) is tuple:
+            self.send_bytes(message)
+        else:
+            self.send_bytes(message.bytes())
+
+    def send_burst(self, messages):
+        """Skicka flera meddelanden direkt efter varandra"""
+        if self.encoder is None:
+            for message in messages:
+                self.send(message)
+            return
+        self.send_bytes(self.encoder.encode(
+            [message if type(message) is tuple else message.bytes() for message in messages]))
+
+class ShadowState:
+    """
+    Senast skickade CC-värde per kanal, med tidpunkt.
+
+    En bytearray med 128 platser per kanal, så uppslag och uppdatering är
+    en indexering. Används för att inte skicka samma värde igen.
+    """
+
+    def __init__(self):
+        self.values = [bytearray([UNKNOWN] * 128) for _ in range(16)]
+        self.timestamps = [array('d', [0.0] * 128) for _ in range(16)]
+
+        # Statistik
+        self.suppressed = 0
+
+    def get(self, channel, cc):
+        """Senast skickade värde, None om okänt"""
+        value = self.values[channel][cc]
+        return None if value == UNKNOWN else value
+
+    def matches(self, channel, cc, value):
+        """Är det här värdet redan skickat?"""
+        return self.values[channel][cc] == value
+
+    def record(self, channel, cc, value):
+        """Kom ihåg att värdet har skickats"""
+        self.values[channel][cc] = value
+        self.timestamps[channel][cc] = time.monotonic()
+
+    def age(self, channel, cc):
+        """Sekunder sedan värdet skickades, None om okänt"""
+        if self.values[channel][cc] == UNKNOWN:
+            return None
+        return time.monotonic() - self.timestamps[channel][cc]
+
+    def forget(self, channel, cc):
+        """Glöm ett värde, nästa sändning går alltid ut"""
+        self.values[channel][cc] = UNKNOWN
+
+    def clear(self, channel=None):
+        """Glöm alla värden (för en kanal eller alla)"""
+        channels = range(16) if channel is None else [channel]
+        for ch in channels:
+            self.values[ch][:] = bytes([UNKNOWN] * 128)
+
+    def known(self, channel):
+        """Alla kända (cc, värde) för en kanal"""
+        return [(cc, value) for cc, value in enumerate(self.values[channel]) if value != UNKNOWN]
+
+class CCCoalescer:
+    """
+    Slår ihop snabba CC-uppdateringar så att bara det senaste värdet skickas.
+
+    Första uppdateringen efter ett lugnt läge skickas direkt. Uppdateringar som
+    kommer medan föregående skickas, eller inom fönstret efter, samlas per
+    (kanal, CC) och bara det senaste värdet går ut. En slider som dras snabbt
+    ger då en ström av färska värden i stället för en kö av gamla.
+    """
+
+    def __init__(self, send, window=0.02):
+        self.send = send          # send(channel, cc, value, description, hires, queued_at)
+        self.window = window      # sekunder mellan två utskick
+        self.pending = {}         # (channel, cc) -> (value, description, hires, queued_at)
+        self.condition = threading.Condition()
+        self.running = True
+
+        # Statistik
+        self.submitted = 0
+        self.coalesced = 0
+
+        self.thread = threading.Thread(target=self._run, name="cc-coalescer", daemon=True)
+        self.thread.start()
+
+    def submit(self, channel, cc, value, description="", hires=False):
+        """
+        Lägg en uppdatering i kö, ersätter ett väntande värde för samma CC.
+
+        Med hires är value 14 bitar och cc parameterns MSB-nummer.
+        """
+        with self.condition:
+            key = (channel, cc)
+            if key in self.pending:
+                self.coalesced += 1
+            self.pending[key] = (value, description, hires, time.monotonic())
+            self.submitted += 1
+            self.condition.notify()
+
+    def discard(self, channel, ccs):
+        """Släng väntande värden för några CC:er (något nyare har skickats)"""
+        with self.condition:
+            for cc in ccs:
+                self.pending.pop((channel, cc), None)
+
+    def _run(self):
+        """Skicka väntande värden, högst en gång per fönster"""
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch = self.pending
+                self.pending = {}
+
+            for (channel, cc), (value, description, hires, queued_at) in batch.items():
+                self.send(channel, cc, value, description, hires, queued_at)
+
+            if self.window > 0:
+                time.sleep(self.window)
+
+    def close(self):
+        """Skicka det som väntar och stoppa tråden"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=1)
+
+class MidiOutputWorker:
+    """
+    En tråd som äger MIDI-porten och skickar allt från en prioritetskö.
+
+    Anroparna (HTTP-trådar, sammanslagningen, automation) lägger bara
+    meddelanden i kön och väntar inte på porten. Noter och realtid går före
+    parameterändringar, som går före svep. Inom samma prioritet skickas i
+    den ordning de lades i kön.
+
+    Meddelanden är råa tupler (se control_change), HiResControl,
+    mido.Message eller poster med expand(shadow, force) som blir råa
+    tupler först vid sändning (PatchRecall). De skickas via RawMidiOutput.
+
+    Med en ShadowState hoppas CC-meddelanden över om samma värde redan är
+    skickat, om de inte lagts i kön med force. Kontrollen görs precis innan
+    sändning, så även dubbletter som hunnit köas filtreras bort.
+
+    latencies är tiden (s) från submit till att meddelandena skrivits till
+    porten, för de senaste LATENCY_SAMPLES posterna som skickades.
+
+    Med hold väntar kön när porten saknas i stället för att meddelandena
+    kastas, och en post som felar vid sändning läggs tillbaka först i kön
+    medan porten kopplas bort (on_port_lost anropas, se PortSupervisor).
+    """
+
+    def __init__(self, port=None, on_sent=None, on_error=None, shadow=None, hold=False):
+        self.port = port
+        self.output = RawMidiOutput(port) if port is not None else None
+        self.port_lock = threading.Lock()
+        self.port_ready = threading.Condition(self.port_lock)
+        self.shadow = shadow
+        self.hold = hold
+        self.running = True
+        self.on_sent = on_sent      # on_sent(messages, description)
+        self.on_error = on_error    # on_error(exception, description)
+        self.on_port_lost = None    # on_port_lost(exception)
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+
+        # Statistik
+        self.sent = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+        self.thread = threading.Thread(target=self._run, name="midi-output", daemon=True)
+        self.thread.start()
+
+    def set_port(self, port):
+        """Byt port (None = frånkopplad), returnerar den gamla porten"""
+        with self.port_lock:
+            old_port = self.port
+            self.port = port
+            self.output = RawMidiOutput(port) if port is not None else None
+            self.port_ready.notify_all()
+            return old_port
+
+    def submit(self, messages, priority=PRIORITY_PARAMETER, description="",
+               want_future=False, force=False, queued_at=None):
+        """
+        Lägg ett eller flera meddelanden i kön utan att vänta.
+
+        Meddelandena i ett anrop skickas direkt efter varandra, utan något
+        annat emellan. Med want_future fås en Future som blir klar (True)
+        när de skickats, eller får undantaget om porten felade. force skickar
+        CC-värden även om de inte har ändrats. queued_at är när ändringen kom
+        in (time.monotonic()), om den väntat någon annanstans först.
+        """
+        future = Future() if want_future else None
+        self.queue.put((priority, next(self.counter), messages, description, future, force,
+                        queued_at or time.monotonic()))
+        return future
+
+    def pending(self):
+        """Ungefärligt antal poster i kön"""
+        return self.queue.qsize()
+
+    def close(self, timeout=1.0):
+        """Skicka det som ligger i kön och stoppa tråden"""
+        with self.port_lock:
+            self.running = False
+            self.port_ready.notify_all()
+        self.queue.put((_PRIORITY_STOP, next(self.counter), None, "", None, False, 0))
+        self.thread.join(timeout=timeout)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            _, _, messages, description, future, force, queued_at = item
+            if messages is None:
+                return
+            if future and not future.running() and not future.set_running_or_notify_cancel():
+                continue  # Avbruten innan den hann skickas
+
+            try:
+                with self.port_lock:
+                    while self.output is None and self.hold and self.running:
+                        self.port_ready.wait()
+                    if self.output is None:
+                        raise IOError("Ingen MIDI-anslutning")
+                    sent = self._prepare(messages, force)
+                    self.output.send_burst(sent)
+                    for message in sent:
+                        self._record(message)
+            except (ValueError, TypeError) as e:
+                # Fel i själva meddelandet, inte i porten
+                self.errors += 1
+                if self.on_error:
+                    self.on_error(e, description)
+                if future:
+                    future.set_exception(e)
+                continue
+            except Exception as e:
+                if self.hold and self.running:
+                    self._port_failed(item, e)
+                    continue
+                self.errors += 1
+                if self.on_error:
+                    self.on_error(e, description)
+                if future:
+                    future.set_exception(e)
+                continue
+
+            self.sent += len(sent)
+            if sent:
+                self.latencies.append(time.monotonic() - queued_at)
+
+            if sent and self.on_sent:
+                self.on_sent(sent, description)
+            if future:
+                future.set_result(True)
+
+    def _port_failed(self, item, error):
+        """Koppla bort porten och lägg tillbaka posten, den skickas vid återanslutning"""
+        self.errors += 1
+        with self.port_lock:
+            self.output = None
+        self.queue.put(item)  # Samma prioritet och nummer, så den är först igen
+        if self.on_error:
+            self.on_error(error, item[3])
+        if self.on_port_lost:
+            self.on_port_lost(error)
+
+    def _prepare(self, messages, force):
+        """Meddelandena som ska skickas: dubbletter bort, 14-bitars CC delade"""
+        prepared = []
+        for message in messages:
+            if type(message) is HiResControl:
+                prepared.extend(self._split_hires(message, force))
+            elif type(message) is not tuple and hasattr(message, 'expand'):
+                # Hel patch (PatchRecall), bara det som skiljer mot shadow
+                prepared.extend(message.expand(self.shadow, force))
+            elif not self._is_redundant(message, force):
+                prepared.append(message)
+        return prepared
+
+    def _split_hires(self, message, force):
+        """
+        MSB och LSB för en 14-bitars CC.
+
+        Har MSB redan rätt värde skickas bara LSB, annars båda med MSB först
+        (en mottagare får nollställa LSB när MSB kommer).
+        """
+        msb, lsb = split_14bit(message.value)
+        status = CC_STATUS[message.channel]
+        shadow = self.shadow
+        if force or shadow is None or not shadow.matches(message.channel, message.msb_cc, msb):
+            return [(status, message.msb_cc, msb), (status, message.lsb_cc, lsb)]
+        if not shadow.matches(message.channel, message.lsb_cc, lsb):
+            return [(status, message.lsb_cc, lsb)]
+        shadow.suppressed += 1
+        return []
+
+    def _is_redundant(self, message, force):
+        """Är det ett CC-värde som redan är skickat?"""
+        if force or self.shadow is None:
+            return False
+        fields = cc_fields(message)
+        if fields and self.shadow.matches(*fields):
+            self.shadow.suppressed += 1
+            return True
+        return False
+
+    def _record(self, message):
+        """Kom ihåg ett skickat CC, meddelandena kommer i sändningsordning"""
+        if self.shadow is not None:
+            fields = cc_fields(message)
+            if fields:
+                channel, cc, value = fields
+                self.shadow.record(channel, cc, value)
+                # Efter MSB är LSB okänd, en 14-bitars CC skickar LSB direkt efter
+                lsb_cc = LSB_FOR_MSB.get(cc)
+                if lsb_cc is not None:
+                    self.shadow.forget(channel, lsb_cc)
+
+class PortSupervisor:
+    """
+    Håller MIDI-porten öppen: hittar den, märker när den försvinner och
+    öppnar den igen.
+
+    Portnamnet sparas efter första sökningen, så den periodiska kontrollen
+    är bara om namnet fortfarande finns bland portarna. När porten förloras
+    (sändningsfel eller kontrollen) väntar skrivartrådens kö medan nya försök
+    görs med ökande intervall. Efter återanslutning skickas allt som finns i
+    ShadowState igen (synthen kan ha startats om) innan kön fortsätter.
+    """
+
+    def __init__(self, worker, patterns=('Sub Phatty', 'Moog'), shadow=None, interval=2.0,
+                 max_backoff=10.0, on_change=None, log=None):
+        self.worker = worker
+        self.patterns = patterns
+        self.shadow = shadow
+        self.interval = interval        # sekunder mellan kontroller
+        self.max_backoff = max_backoff  # längsta väntan mellan försök
+        self.on_change = on_change      # on_change(port, name), port None = förlorad
+        self.log = log or (lambda message, *args: None)
+
+        # Utbytbara för tester och virtuella portar
+        self.list_ports = mido.get_output_names
+        self.open_port = mido.open_output
+
+        self.port_name = None           # sparat namn, finns kvar under avbrott
+        self.connected = False
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+        # Statistik
+        self.reconnects = 0
+
+        worker.on_port_lost = self.report_error
+
+    def start(self):
+        """Försök ansluta direkt och starta bevakningen"""
+        self.connect()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="port-supervisor", daemon=True)
+        self.thread.start()
+
+    def connect(self, rescan=True):
+        """
+        Anslut (eller återanslut) nu, returnerar True om det lyckades.
+
+        Med rescan glöms det sparade namnet och portarna söks igen.
+        """
+        with self.lock:
+            if rescan:
+                self._disconnect()
+                self.port_name = None
+            try:
+                return self._open()
+            except Exception as e:
+                self.log("✗ MIDI-anslutningsfel: %s", e)
+                return False
+
+    def report_error(self, error=None):
+        """Sändningen felade, kontrollera porten direkt"""
+        with self.lock:
+            if self.connected:
+                self._lost()
+        self.wakeup.set()
+
+    def close(self):
+        """Stoppa bevakningen och stäng porten"""
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=1)
+        with self.lock:
+            self._disconnect()
+
+    def _run(self):
+        backoff = None
+        while True:
+            self.wakeup.wait(self.interval if backoff is None else backoff)
+            self.wakeup.clear()
+            if not self.running:
+                return
+
+            with self.lock:
+                if self.connected:
+                    if self._port_present():
+                        continue
+                    self._lost()
+
+                if self._try_open() or self.port_name is None:
+                    backoff = None  # Ansluten, eller aldrig hittad och letar i vanlig takt
+                else:
+                    backoff = min((backoff or self.interval / 4) * 2, self.max_backoff)
+
+    def _port_present(self):
+        try:
+            return self.port_name in self.list_ports()
+        except Exception:
+            return False
+
+    def _find_port(self):
+        """Sparat namn om det finns, annars första port som matchar"""
+        names = self.list_ports()
+        if self.port_name in names:
+            return self.port_name
+        for name in names:
+            if any(pattern in name for pattern in self.patterns):
+                return name
+        return None
+
+    def _open(self):
+        name = self._find_port()
+        if name is None:
+            return False
+
+        port = self.open_port(name)
+
+        # Återställ synthen innan kön släpps på (skrivartråden väntar så länge)
+        restored = 0
+        if self.shadow is not None:
+            messages = [(CC_STATUS[channel], cc, value)
+                        for channel in range(16)
+                        for cc, value in self.shadow.known(channel)]
+            try:
+                RawMidiOutput(port).send_burst(messages)
+            except Exception:
+                port.close()
+                raise
+            restored = len(messages)
+
+        old_port = self.worker.set_port(port)
+        if old_port is not None and old_port is not port:
+            self._close_port(old_port)
+        self.port_name = name
+        self.connected = True
+
+        if restored:
+            self.reconnects += 1
+            self.log("✓ Återansluten till: %s (%d värden återställda)", name, restored)
+        else:
+            self.log("✓ Ansluten till: %s", name)
+        if self.on_change:
+            self.on_change(port, name)
+        return True
+
+    def _try_open(self):
+        """_open utan undantag, för bakgrundsförsöken"""
+        try:
+            return self._open()
+        except Exception:
+            return False
+
+    def _lost(self):
+        self.connected = False
+        self._close_port(self.worker.set_port(None))
+        self.log("⚠️ MIDI-porten %s försvann, försöker återansluta", self.port_name)
+        if self.on_change:
+            self.on_change(None, self.port_name)
+
+    def _disconnect(self):
+        """Stäng porten utan att räkna det som ett avbrott"""
+        old_port = self.worker.set_port(None)
+        self.connected = False
+        self._close_port(old_port)
+
+    def _close_port(self, port):
+        if port is None:
+            return
+        try:
+            port.close()
+        except Exception:
+            pass
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty-morfning
+
+Glider mellan två patchar. En bild (frame) räknas ut för hela
+parametervektorn på en gång, med NumPy om det finns och annars i ren
+Python. Parametrar med namngivna värden (modulationskälla, oktav,
+filterpoler, ...) hamnar alltid på ett av värdena i CSV:ns usage-kolumn.
+
+Bilderna skickas som PatchRecall, så bara de CC:er som ändrats sedan förra
+bilden går ut på länken.
+"""
+
+import math
+
+from sub_phatty_automation import AutomationJob
+from sub_phatty_params import PARAMETERS
+from sub_phatty_patch import PATCH_SIZE, UNSET, Patch, PatchRecall
+
+try:
+    import numpy  # Valfritt, ren Python används annars
+except ImportError:
+    numpy = None
+
+# Nyckel i AutomationEngine för en enhets morf (en åt gången per kanal)
+MORPH = 'morph'
+
+# Ungefärligt antal byte per ändrad CC i en skur (running status ger 2-3)
+_BYTES_PER_CHANGE = 3
+
+def _snap_row(parameter):
+    """Tabell 0-255 -> närmaste tillåtna värde för en parameter (255 = inte satt)"""
+    legal = sorted(parameter.values.values())
+    row = []
+    for value in range(256):
+        if value == UNSET:
+            row.append(UNSET)
+        elif legal:
+            # Närmaste namngivna värde, det lägre vid lika avstånd
+            row.append(min(legal, key=lambda candidate: (abs(candidate - value), candidate)))
+        else:
+            row.append(min(max(value, parameter.min_value), parameter.max_value))
+    return row
+
+# En rad per parameter i CSV-ordning, byggs en gång
+SNAP_TABLE = [_snap_row(parameter) for parameter in PARAMETERS]
+
+if numpy is not None:
+    _SNAP_ARRAY = numpy.array(SNAP_TABLE, dtype=numpy.uint8)
+    _ROWS = numpy.arange(PATCH_SIZE)
+
+class Morph:
+    """
+    Morf från source till target.
+
+    Värden som bara är satta i den ena patchen hålls fast under hela
+    morfen, värden som inte är satta i någon av dem förblir osatta.
+    """
+
+    def __init__(self, source, target):
+        start = bytes(source)
+        end = bytes(target)
+        # Osatta ändar tar den andra ändens värde, osatta i båda blir kvar UNSET
+        self.start = bytes(e if s == UNSET else s for s, e in zip(start, end))
+        self.end = bytes(s if e == UNSET else e for s, e in zip(self.start, end))
+
+        if numpy is not None:
+            self._start = numpy.frombuffer(self.start, dtype=numpy.uint8).astype(numpy.float32)
+            self._span = numpy.frombuffer(self.end, dtype=numpy.uint8).astype(numpy.float32)
+            self._span -= self._start
+
+    def frame(self, position):
+        """Patchen vid position 0.0 (source) till 1.0 (target), kastar ValueError för nan"""
+        if math.isnan(position):
+            raise ValueError("Ogiltig position: nan")
+        position = min(max(position, 0.0), 1.0)
+        if numpy is not None:
+            raw = numpy.rint(self._start + self._span * position).astype(numpy.intp)
+            return Patch(_SNAP_ARRAY[_ROWS, raw].tobytes())
+        return Patch(bytes(SNAP_TABLE[index][round(s + (e - s) * position)]
+                           for index, (s, e) in enumerate(zip(self.start, self.end))))
+
+class MorphJob(AutomationJob):
+    """Tidsstyrd morf i AutomationEngine, en bild per steg"""
+
+    def __init__(self, channel, morph, duration, curve='linear', description=""):
+        super().__init__(None, channel, MORPH, 0, 1, duration, curve, None, description)
+        self.morph = morph
+
+    def value_at(self, progress):
+        """Bilden vid progress (0.0-1.0), kurvan bestämmer farten"""
+        if progress >= 1:
+            return self.morph.frame(1.0)
+        return self.morph.frame(self.curve(progress))
+
+    def message(self, frame):
+        return PatchRecall(self.channel, frame)
+
+    def cost(self, frame):
+        """Byte på bussen, räknat på ändringarna sedan förra bilden"""
+        if self.last_value is None:
+            return _BYTES_PER_CHANGE * len(frame.set_indices())
+        return _BYTES_PER_CHANGE * len(self.last_value.diff(frame))
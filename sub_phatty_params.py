@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty-parametrar
+
+Läser midi-implementation.csv (officiella MIDI-specen) en gång till en
+tabell som resten av programmet slår upp parametrar i.
+"""
+
+import csv
+import os
+import re
+from collections import namedtuple
+
+# Högsta värde för parametrar med både MSB och LSB (14 bitar)
+HIRES_MAX = 16383
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'midi-implementation.csv')
+
+# index   - position i CSV-filen (används som ordning för hela patchar)
+# key     - namn i URL:er och kommandon, t.ex. 'filter_cutoff_frequency'
+# values  - namngivna värden från usage-kolumnen, t.ex. {'Off': 0, 'On': 64}
+# labels  - samma sak med gemener som nyckel, för uppslag
+Parameter = namedtuple('Parameter', [
+    'index', 'key', 'name', 'section', 'cc_msb', 'cc_lsb',
+    'min_value', 'max_value', 'values', 'labels'
+])
+
+def parameter_key(name):
+    """'Pitch mod, oscillator 2 only' -> 'pitch_mod_oscillator_2_only'"""
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+def parse_usage(usage):
+    """
+    Tolka usage-kolumnen till {namn: värde}.
+
+    Oftast '0: Off; 64: On', men VCO-oktaverna använder komma. Intervall som
+    '0~24: Transpose ...' är inga uppräkningar och ger en tom dict.
+    """
+    parts = usage.split(';')
+    if len(parts) == 1:
+        parts = usage.split(',')
+
+    values = {}
+    for part in parts:
+        match = re.match(r'^\s*(\d+)\s*:\s*(.+?)\s*$', part)
+        if match:
+            values[match.group(2)] = int(match.group(1))
+    return values
+
+def load_parameters(path=CSV_PATH):
+    """Läs alla parametrar i CSV-ordning"""
+    parameters = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            values = parse_usage(row['usage'])
+            parameters.append(Parameter(
+                index=len(parameters),
+                key=parameter_key(row['parameter_name']),
+                name=row['parameter_name'],
+                section=row['section'],
+                cc_msb=int(row['cc_msb']),
+                cc_lsb=int(row['cc_lsb']) if row['cc_lsb'] else None,
+                min_value=int(row['cc_min_value']),
+                max_value=int(row['cc_max_value']),
+                values=values,
+                labels={label.lower(): value for label, value in values.items()}
+            ))
+    return parameters
+
+def resolve_value(parameter, value):
+    """
+    Översätt ett värde till CC-värde.
+
+    Tar emot antingen ett tal inom parameterns intervall eller ett namn från
+    usage-kolumnen ('On', 'Square LFO', ...). Kastar ValueError annars.
+    """
+    if isinstance(value, str):
+        label = value.strip().lower()
+        if label in parameter.labels:
+            return parameter.labels[label]
+
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Ogiltigt värde för {parameter.name}: {value}")
+
+    if number < parameter.min_value or number > parameter.max_value:
+        raise ValueError(f"{parameter.name} måste vara "
+                         f"{parameter.min_value}-{parameter.max_value}, fick: {number}")
+    return number
+
+def resolve_hires_value(parameter, value):
+    """
+    Översätt ett 14-bitars värde (0-16383) för en parameter med MSB och LSB.
+
+    Kastar ValueError om parametern saknar LSB eller värdet är ogiltigt.
+    """
+    if parameter.cc_lsb is None:
+        raise ValueError(f"{parameter.name} har ingen 14-bitars CC")
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Ogiltigt värde för {parameter.name}: {value}")
+
+    if number < 0 or number > HIRES_MAX:
+        raise ValueError(f"{parameter.name} måste vara 0-{HIRES_MAX}, fick: {number}")
+    return number
+
+PARAMETERS = load_parameters()
+PARAMETERS_BY_KEY = {parameter.key: parameter for parameter in PARAMETERS}
+PARAMETERS_BY_CC = {parameter.cc_msb: parameter for parameter in PARAMETERS}
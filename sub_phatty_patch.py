@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty-patchar
+
+En patch är alla parametrar från midi-implementation.csv som en bytearray
+i CSV-ordning, en byte per parameter och 0xFF för värden som inte är satta.
+Ögonblicksbilder delar minne tills någon av dem ändras, och skillnaden
+mellan två patchar räknas ut för hela vektorn på en gång.
+"""
+
+import re
+from operator import itemgetter
+
+from sub_phatty_midi import CC_STATUS, UNKNOWN
+from sub_phatty_params import PARAMETERS, PARAMETERS_BY_KEY, resolve_value
+
+# Värde för parametrar som inte är satta, samma som i ShadowState
+UNSET = UNKNOWN
+
+PATCH_SIZE = len(PARAMETERS)
+
+# Hämtar alla parametrars MSB ur en ShadowState-rad (indexerad på CC) på en gång
+_MSB_GETTER = itemgetter(*(parameter.cc_msb for parameter in PARAMETERS))
+
+# Bytes som inte är noll i en XOR mellan två patchar
+_NONZERO = re.compile(rb'[^\x00]')
+
+# Tillåtna bytes i en patch: databyte 0-127 och UNSET. Allt annat vore en
+# statusbyte på länken, den råa utgången validerar inget själv.
+_LEGAL_BYTES = bytes(range(128)) + bytes([UNSET])
+
+def _index(key):
+    """Parameterns position från nyckel, index eller Parameter"""
+    if isinstance(key, int):
+        if not 0 <= key < PATCH_SIZE:
+            raise IndexError(f"Parameterindex utanför patchen: {key}")
+        return key
+    if isinstance(key, str):
+        if key not in PARAMETERS_BY_KEY:
+            raise KeyError(f"Okänd parameter: {key}")
+        return PARAMETERS_BY_KEY[key].index
+    return key.index
+
+class Patch:
+    """
+    Värdena för alla parametrar i en patch.
+
+    Data ligger i _data, en bytearray när patchen är egen och bytes när den
+    delas med en ögonblicksbild. Första ändringen efter snapshot() kopierar
+    (copy-on-write), så en bild som aldrig ändras kostar ingen kopia.
+    """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data=None):
+        if data is None:
+            self._data = bytearray([UNSET]) * PATCH_SIZE
+            return
+        if len(data) != PATCH_SIZE:
+            raise ValueError(f"En patch har {PATCH_SIZE} värden, fick: {len(data)}")
+        data = bytearray(data)
+        invalid = data.translate(None, _LEGAL_BYTES)
+        if invalid:
+            raise ValueError(f"Ogiltigt värde i patch: {invalid[0]}")
+        self._data = data
+
+    @classmethod
+    def from_values(cls, values):
+        """Patch från {parameter: värde}, värden som tal eller namn ('On', ...)"""
+        patch = cls()
+        patch.update(values)
+        return patch
+
+    @classmethod
+    def from_shadow(cls, shadow, channel):
+        """Det som senast skickades på en kanal enligt en ShadowState"""
+        patch = cls.__new__(cls)
+        patch._data = bytearray(_MSB_GETTER(shadow.values[channel]))
+        return patch
+
+    def snapshot(self):
+        """Oföränderlig kopia som delar minne med patchen tills någon ändras"""
+        if type(self._data) is not bytes:
+            self._data = bytes(self._data)
+        copy = Patch.__new__(Patch)
+        copy._data = self._data
+        return copy
+
+    def _writable(self):
+        if type(self._data) is bytes:
+            self._data = bytearray(self._data)
+        return self._data
+
+    def __getitem__(self, key):
+        """Värdet för en parameter, None om det inte är satt"""
+        value = self._data[_index(key)]
+        return None if value == UNSET else value
+
+    def __setitem__(self, key, value):
+        """Sätt en parameter, None tar bort värdet. Kastar ValueError för ogiltiga värden."""
+        index = _index(key)
+        if value is not None:
+            value = resolve_value(PARAMETERS[index], value)
+        self._writable()[index] = UNSET if value is None else value
+
+    def update(self, values):
+        """Sätt flera parametrar från {parameter: värde}"""
+        # Allt valideras innan något skrivs
+        resolved = []
+        for key, value in values.items():
+            index = _index(key)
+            resolved.append((index, UNSET if value is None
+                             else resolve_value(PARAMETERS[index], value)))
+        data = self._writable()
+        for index, value in resolved:
+            data[index] = value
+
+    def merge(self, other):
+        """Ta över alla värden som är satta i other"""
+        data = self._writable()
+        for index in other.set_indices():
+            data[index] = other._data[index]
+
+    def __len__(self):
+        return PATCH_SIZE
+
+    def __eq__(self, other):
+        if not isinstance(other, Patch):
+            return NotImplemented
+        return self._data == other._data
+
+    def __bytes__(self):
+        return bytes(self._data)
+
+    def __repr__(self):
+        return f"Patch({len(self.set_indices())}/{PATCH_SIZE} satta)"
+
+    def items(self):
+        """(Parameter, värde) för alla satta parametrar, i CSV-ordning"""
+        data = self._data
+        return [(PARAMETERS[index], data[index]) for index in self.set_indices()]
+
+    def to_dict(self):
+        """{nyckel: värde} för alla satta parametrar"""
+        return {parameter.key: value for parameter, value in self.items()}
+
+    def set_indices(self):
+        """Index för parametrar som är satta"""
+        data = self._data
+        if UNSET not in data:
+            return list(range(PATCH_SIZE))
+        return [index for index, value in enumerate(data) if value != UNSET]
+
+    def diff(self, other):
+        """
+        Index där patcharna skiljer sig (även satt mot osatt).
+
+        Båda vektorerna XOR:as som ett heltal och bara de byte som inte blev
+        noll letas upp, i stället för att jämföra parameter för parameter.
+        """
+        xor = int.from_bytes(self._data, 'big') ^ int.from_bytes(other._data, 'big')
+        if not xor:
+            return []
+        return [match.start() for match in _NONZERO.finditer(xor.to_bytes(PATCH_SIZE, 'big'))]
+
+    def changes(self, target):
+        """(Parameter, värde) som behöver skickas för att gå härifrån till target"""
+        data = target._data
+        return [(PARAMETERS[index], data[index]) for index in self.diff(target)
+                if data[index] != UNSET]
+
+class PatchRecall:
+    """
+    En hel patch i MidiOutputWorkers kö.
+
+    Skillnaden mot ShadowState räknas ut av skrivartråden precis innan
+    sändning, när allt som låg före i kön redan är skickat. Då går bara de
+    CC:er som faktiskt skiljer ut, och inget värde som ligger i kön kan göra
+    skillnaden inaktuell.
+    """
+
+    __slots__ = ('channel', 'patch')
+
+    def __init__(self, channel, patch):
+        self.channel = channel
+        self.patch = patch.snapshot()
+
+    def expand(self, shadow, force=False):
+        """
+        Råa CC-meddelanden för de värden som skiljer (alla satta med force).
+
+        Patchen har 7-bitarsvärden. En parameter vars LSB senast skickades
+        som något annat än 0 (14-bitars CC) skiljer därför även när MSB
+        stämmer. Skrivartråden glömmer LSB för varje MSB den skickar.
+        """
+        status = CC_STATUS[self.channel]
+        if force or shadow is None:
+            changes = self.patch.items()
+        else:
+            changes = Patch.from_shadow(shadow, self.channel).changes(self.patch)
+            changed = {parameter.index for parameter, _ in changes}
+            row = shadow.values[self.channel]
+            changes += [(parameter, value) for parameter, value in self.patch.items()
+                        if parameter.cc_lsb is not None and parameter.index not in changed
+                        and row[parameter.cc_lsb] not in (0, UNSET)]
+            shadow.suppressed += len(self.patch.set_indices()) - len(changes)
+        return [(status, parameter.cc_msb, value) for parameter, value in changes]
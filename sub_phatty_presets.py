@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Sub Phatty-presets
+
+Namngivna patchar i en binärfil med en post av fast storlek per preset,
+som läses via mmap. Vid start läses bara flagga och namn i varje post för
+att bygga namnindexet, värdena läses först när en preset laddas.
+
+Filformat (alla tal little-endian):
+    huvud   'SPPR', version (u16), postlängd (u16), antal värden (u16), 6 reserverade byte
+    post    flagga (1 = giltig, 0 = borttagen), namn (32 byte UTF-8, nollutfyllt),
+            ett värde per parameter i CSV-ordning (0xFF = inte satt)
+
+Ändringar skrivs bara till slutet av filen. En preset som skrivs över
+eller tas bort markeras som borttagen, och filen packas om när de
+borttagna posterna blir fler än de giltiga.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+from sub_phatty_patch import PATCH_SIZE, Patch
+
+PRESETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'presets.bin')
+
+MAGIC = b'SPPR'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH6x')
+
+# Längsta namn i byte (UTF-8), namnet blir också en del av URL:er och loggen
+MAX_NAME_LENGTH = 32
+
+RECORD_LIVE = 1
+RECORD_DELETED = 0
+RECORD_SIZE = 1 + MAX_NAME_LENGTH + PATCH_SIZE
+_VALUES_OFFSET = 1 + MAX_NAME_LENGTH
+
+# Packa inte om för några enstaka borttagna poster
+COMPACT_MIN_DELETED = 16
+
+def check_name(name):
+    """Namnet utan blanksteg runt, kastar ValueError för tomma eller för långa namn"""
+    name = (name or '').strip()
+    if not name:
+        raise ValueError("Presetnamnet är tomt")
+    if len(name.encode('utf-8')) > MAX_NAME_LENGTH:
+        raise ValueError(f"Presetnamnet får vara högst {MAX_NAME_LENGTH} byte: {name}")
+    return name
+
+def encode_record(name, patch):
+    """En post för filen"""
+    return (bytes([RECORD_LIVE]) + name.encode('utf-8').ljust(MAX_NAME_LENGTH, b'\x00') +
+            bytes(patch))
+
+class PresetLibrary:
+    """
+    Presets i en fil med poster av fast storlek, via mmap.
+
+    index är {namn: postens position i filen}. Att lista och söka går bara
+    mot indexet och att ladda en preset läser en post, oavsett hur många
+    presets filen har.
+    """
+
+    def __init__(self, path=PRESETS_PATH):
+        self.path = path
+        self.index = {}
+        self.deleted = 0
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None         # None tills filen finns (skapas vid första save)
+        if os.path.exists(self.path):
+            self._open()
+
+    def _open(self):
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if len(self.map) < HEADER.size:
+            raise ValueError(f"{self.path} är ingen presetfil")
+        magic, version, record_size, patch_size = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} är ingen presetfil (version {VERSION})")
+        if record_size != RECORD_SIZE or patch_size != PATCH_SIZE:
+            raise ValueError(f"{self.path} har {patch_size} värden per preset, ska ha {PATCH_SIZE}")
+
+        # Bara flagga och namn läses, en halvskriven sista post hoppas över
+        self.index = {}
+        self.deleted = 0
+        end = HEADER.size + (len(self.map) - HEADER.size) // RECORD_SIZE * RECORD_SIZE
+        for offset in range(HEADER.size, end, RECORD_SIZE):
+            if self.map[offset] != RECORD_LIVE:
+                self.deleted += 1
+                continue
+            name = self.map[offset + 1:offset + _VALUES_OFFSET].rstrip(b'\x00').decode('utf-8')
+            if name in self.index:
+                # Avbruten överskrivning, den senare posten gäller
+                self.deleted += 1
+            self.index[name] = offset
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.file.close()
+                self.map = self.file = None
+
+    def names(self):
+        """Alla namn i bokstavsordning"""
+        with self.lock:
+            return sorted(self.index)
+
+    def search(self, text):
+        """Namn som innehåller text (oavsett versaler)"""
+        text = text.lower()
+        with self.lock:
+            return sorted(name for name in self.index if text in name.lower())
+
+    def get(self, name):
+        """Patchen för ett namn, kastar ValueError för okända namn och skadade poster"""
+        with self.lock:
+            offset = self.index.get(name)
+            if offset is None:
+                raise ValueError(f"Okänd preset: {name}")
+            start = offset + _VALUES_OFFSET
+            try:
+                return Patch(self.map[start:start + PATCH_SIZE])
+            except ValueError as e:
+                raise ValueError(f"Preset {name} är skadad: {e}")
+
+    def save(self, name, patch):
+        """Spara (eller skriv över) en preset, returnerar namnet"""
+        name = check_name(name)
+        record = encode_record(name, patch)
+        with self.lock:
+            old = self.index.get(name)
+            # Den nya posten skrivs innan den gamla markeras, så att ett
+            # avbrott lämnar minst en av dem
+            self.index[name] = self._append(record)
+            if old is not None:
+                self._mark_deleted(old)
+            self._compact_if_needed()
+        return name
+
+    def delete(self, name):
+        """Ta bort en preset, False om den inte fanns"""
+        with self.lock:
+            offset = self.index.pop(name, None)
+            if offset is None:
+                return False
+            self._mark_deleted(offset)
+            self._compact_if_needed()
+            return True
+
+    def compact(self):
+        """Skriv om filen med bara giltiga poster"""
+        with self.lock:
+            if self.map is not None:
+                self._compact()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _append(self, record):
+        """Skriv en post sist i filen, returnerar dess position"""
+        if self.map is None:
+            with open(self.path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE, PATCH_SIZE))
+            self._open()
+
+        offset = HEADER.size + (len(self.map) - HEADER.size) // RECORD_SIZE * RECORD_SIZE
+        self.file.seek(offset)
+        self.file.write(record)
+        self.file.truncate()
+        self.file.flush()
+        # Filen har vuxit, mappningen måste göras om
+        self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        return offset
+
+    def _mark_deleted(self, offset):
+        self.map[offset] = RECORD_DELETED
+        self.map.flush()
+        self.deleted += 1
+
+    def _compact_if_needed(self):
+        if self.deleted >= COMPACT_MIN_DELETED and self.deleted > len(self.index):
+            self._compact()
+
+    def _compact(self):
+        temporary = self.path + '.tmp'
+        index = {}
+        with open(temporary, 'wb') as f:
+            f.write(self.map[:HEADER.size])
+            offset = HEADER.size
+            for name, old in sorted(self.index.items(), key=lambda item: item[1]):
+                f.write(self.map[old:old + RECORD_SIZE])
+                index[name] = offset
+                offset += RECORD_SIZE
+        self.map.close()
+        self.file.close()
+        os.replace(temporary, self.path)  # En halvskriven fil ersätter aldrig den gamla
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.index = index
+        self.deleted = 0
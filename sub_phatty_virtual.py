@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Virtuell Sub Phatty
+
+En modell av synthen att köra mot utan hårdvara, t.ex. i benchmarks. Den
+tar emot MIDI som en riktig port (mido.Message eller råa byte), håller
+alla parametrar från midi-implementation.csv i en tabell, tar lika lång
+tid på sig som 31.25 kbaud-länken och ekar ändringar på en ingång.
+
+SysEx-formatet för patchar är inte känt (se utils/sysex_analyzer.py), så
+emulatorn använder ett eget på samma header:
+    F0 04 06 04 <ett värde per parameter i CSV-ordning> F7   patch
+    F0 04 06 06 F7                                           begär patch
+"""
+
+import queue
+import threading
+import time
+
+import mido
+
+from sub_phatty_params import PARAMETERS
+
+VIRTUAL_PORT_NAME = 'Virtual Sub Phatty'
+
+# 31250 baud, 10 bitar per byte (start, 8 data, stopp)
+WIRE_BAUD = 31250
+BYTE_TIME = 10 / WIRE_BAUD
+
+# Sändbuffert i gränssnittet, sändaren blockerar först när den är full
+WIRE_BUFFER = 64
+
+# Moog och Sub Phatty i SysEx
+SYSEX_HEADER = (0x04, 0x06)
+SYSEX_PATCH = 0x04
+SYSEX_REQUEST = 0x06
+
+# Antal databyte per kanalmeddelande, efter statusbytets övre halva
+_DATA_LENGTH = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+class VirtualSubPhatty:
+    """
+    Synthens tillstånd och MIDI-tolkning.
+
+    values och lsb_values är bytearrays i CSV-ordning. Med wire_timing
+    blockerar sändningen när mer än WIRE_BUFFER byte väntar på länken,
+    precis som en full USB-MIDI-buffert gör.
+    """
+
+    def __init__(self, channel=1, name=VIRTUAL_PORT_NAME, wire_timing=True, echo=True):
+        self.channel = channel
+        self.name = name
+        self.wire_timing = wire_timing
+        self.echo = echo
+
+        self.values = bytearray(parameter.min_value for parameter in PARAMETERS)
+        self.lsb_values = bytearray(len(PARAMETERS))
+        self.msb_index = {parameter.cc_msb: parameter.index for parameter in PARAMETERS}
+        self.lsb_index = {parameter.cc_lsb: parameter.index
+                          for parameter in PARAMETERS if parameter.cc_lsb is not None}
+
+        self.lock = threading.Lock()
+        self.inputs = []
+        self.wire_free_at = 0.0
+
+        # Tolkningens läge (running status och SysEx kan delas över anrop)
+        self.status = None
+        self.data = []
+        self.sysex = None
+
+        # Statistik
+        self.messages = 0
+        self.bytes = 0
+        self.changes = 0
+
+    def open_output(self, name=None):
+        """En utgång mot synthen (som mido.open_output)"""
+        return VirtualOutput(self)
+
+    def open_input(self, name=None, callback=None):
+        """En ingång som tar emot synthens eko (som mido.open_input)"""
+        port = VirtualInput(self, callback)
+        with self.lock:
+            self.inputs.append(port)
+        return port
+
+    def attach(self, supervisor):
+        """Låt en PortSupervisor hitta och öppna den här synthen i stället för USB"""
+        # Namnet ska matcha enhetens mönster, annars hittas porten inte
+        name = f"{supervisor.patterns[0]} ({self.name})"
+        supervisor.list_ports = lambda: [name]
+        supervisor.open_port = self.open_output
+
+    def get(self, key):
+        """Aktuellt värde för en parameter (nyckel eller index)"""
+        index = key if isinstance(key, int) else next(
+            parameter.index for parameter in PARAMETERS if parameter.key == key)
+        return self.values[index]
+
+    def patch_sysex(self):
+        """Hela patchen som SysEx-data (utan F0/F7)"""
+        return SYSEX_HEADER + (SYSEX_PATCH,) + tuple(self.values)
+
+    def receive(self, data):
+        """Ta emot byte från länken (blockerar med wire_timing)"""
+        if self.wire_timing:
+            self._wait_for_wire(len(data))
+        with self.lock:
+            self.bytes += len(data)
+            echoes = self._parse(data)
+        for message in echoes:
+            self._echo(message)
+
+    def _wait_for_wire(self, count):
+        """Vänta tills count byte ryms i sändbufferten"""
+        with self.lock:
+            start = max(time.monotonic(), self.wire_free_at)
+            self.wire_free_at = start + count * BYTE_TIME
+            done = self.wire_free_at
+        delay = done - time.monotonic() - WIRE_BUFFER * BYTE_TIME
+        if delay > 0:
+            time.sleep(delay)
+
+    def _parse(self, data):
+        """Tolka en byteström, returnerar meddelanden att eka"""
+        echoes = []
+        for byte in data:
+            if byte >= 0xF8:
+                continue  # Realtid, påverkar inget
+            if byte == 0xF0:
+                self.sysex = []
+                self.status = None
+                continue
+            if byte == 0xF7:
+                if self.sysex is not None:
+                    echoes.extend(self._handle_sysex(self.sysex))
+                    self.sysex = None
+                continue
+            if self.sysex is not None:
+                if byte < 0x80:
+                    self.sysex.append(byte)
+                    continue
+                self.sysex = None  # Avbruten SysEx
+            if byte >= 0x80:
+                self.status = byte if byte < 0xF0 else None
+                self.data = []
+                continue
+            if self.status is None:
+                continue
+
+            self.data.append(byte)
+            if len(self.data) == _DATA_LENGTH[self.status & 0xF0]:
+                echoes.extend(self._handle_channel(self.status, self.data))
+                self.data = []  # Statusbytet gäller nästa meddelande också
+        return echoes
+
+    def _handle_channel(self, status, data):
+        self.messages += 1
+        if status != 0xB0 | self.channel:
+            return []
+
+        cc, value = data
+        if cc in self.msb_index:
+            table, index = self.values, self.msb_index[cc]
+        elif cc in self.lsb_index:
+            table, index = self.lsb_values, self.lsb_index[cc]
+        else:
+            return []
+
+        if table[index] == value:
+            return []
+        table[index] = value
+        self.changes += 1
+        return [mido.Message('control_change', channel=self.channel, control=cc, value=value)]
+
+    def _handle_sysex(self, data):
+        self.messages += 1
+        if tuple(data[:2]) != SYSEX_HEADER or len(data) < 3:
+            return []
+
+        command = data[2]
+        if command == SYSEX_REQUEST:
+            return [mido.Message('sysex', data=self.patch_sysex())]
+        if command != SYSEX_PATCH:
+            return []
+
+        echoes = []
+        for index, value in enumerate(data[3:3 + len(PARAMETERS)]):
+            if self.values[index] != value:
+                self.values[index] = value
+                self.changes += 1
+                echoes.append(mido.Message('control_change', channel=self.channel,
+                                           control=PARAMETERS[index].cc_msb, value=value))
+        return echoes
+
+    def _echo(self, message):
+        if not self.echo:
+            return
+        with self.lock:
+            inputs = list(self.inputs)
+        for port in inputs:
+            port.deliver(message)
+
+class VirtualOutput:
+    """Utgång till en VirtualSubPhatty, med samma gränssnitt som en mido-port"""
+
+    def __init__(self, synth):
+        self.synth = synth
+        self.name = synth.name
+        self.closed = False
+
+    def send(self, message):
+        """Skicka ett mido.Message"""
+        if self.closed:
+            raise ValueError("Porten är stängd")
+        self.synth.receive(message.bytes())
+
+    def write_bytes(self, data):
+        """Skicka råa byte, används av RawMidiOutput (med running status)"""
+        if self.closed:
+            raise ValueError("Porten är stängd")
+        self.synth.receive(data)
+
+    def close(self):
+        self.closed = True
+
+class VirtualInput:
+    """Ingång från en VirtualSubPhatty, med samma gränssnitt som en mido-port"""
+
+    def __init__(self, synth, callback=None):
+        self.synth = synth
+        self.name = synth.name
+        self.callback = callback
+        self.closed = False
+        self.pending = queue.SimpleQueue()
+
+    def deliver(self, message):
+        if self.closed:
+            return
+        if self.callback:
+            self.callback(message)
+        else:
+            self.pending.put(message)
+
+    def receive(self, block=True):
+        """Nästa meddelande, None om block=False och inget finns"""
+        try:
+            return self.pending.get(block)
+        except queue.Empty:
+            return None
+
+    def poll(self):
+        return self.receive(block=False)
+
+    def iter_pending(self):
+        while True:
+            message = self.poll()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        self.closed = True
+        with self.synth.lock:
+            if self in self.synth.inputs:
+                self.synth.inputs.remove(self)
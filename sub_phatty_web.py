@@ -6,21 +6,67 @@ En webbaserad controller som fungerar i vilken webbläsare som helst.
 Kringgår tkinter-problem på äldre macOS-versioner.
 """
 
-import mido
 import http.server
-import socketserver
 import urllib.parse
 import json
 import threading
 import webbrowser
 import time
 import os
+import argparse
+import base64
+import hashlib
+import struct
+import queue
+import gzip
+
+try:
+    import brotli  # Valfritt, gzip används annars
+except ImportError:
+    brotli = None
+
+from sub_phatty_automation import check_duration
+from sub_phatty_devices import DEFAULT_PATTERNS, DeviceRegistry, SynthDevice, parse_device_spec
+from sub_phatty_log import LogRingBuffer, LogWriter, format_record
+from sub_phatty_morph import Morph
+from sub_phatty_params import (HIRES_MAX, PARAMETERS, PARAMETERS_BY_CC, PARAMETERS_BY_KEY,
+                               resolve_hires_value, resolve_value)
+from sub_phatty_presets import PRESETS_PATH, PresetLibrary
+from sub_phatty_virtual import VirtualSubPhatty
+
+# Magisk konstant från RFC 6455 för Sec-WebSocket-Accept
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Sekunder mellan keepalive-kommentarer på /events
+EVENTS_KEEPALIVE = 15
+
+# Högsta antal öppna /events- och /ws-strömmar (två per öppen sida). De
+# körs i egna trådar utanför arbetarpoolen.
+MAX_STREAMS = 64
+
+# Största tillåtna POST-kropp (en batch med alla parametrar ryms med råge)
+MAX_POST_BODY = 64 * 1024
+
+# Vanliga svar byggs en gång i stället för json.dumps per förfrågan
+RESPONSE_SUCCESS = json.dumps({'success': True}).encode('utf-8')
+RESPONSE_FAILURE = json.dumps({'success': False}).encode('utf-8')
+RESPONSE_PARAMETERS = json.dumps({'parameters': [
+    {
+        'key': parameter.key,
+        'name': parameter.name,
+        'section': parameter.section,
+        'cc': parameter.cc_msb,
+        'cc_lsb': parameter.cc_lsb,
+        'min': parameter.min_value,
+        'max': parameter.max_value,
+        'values': parameter.values
+    }
+    for parameter in PARAMETERS
+]}).encode('utf-8')
 
 class SubPhattyWebController:
-    def __init__(self):
-        self.outport = None
-        self.midi_channel = 1  # Kanal 2 (0-indexerat)
-        
+    def __init__(self, coalesce_window=0.02, log_capacity=50, ramp_rate=100, bus_budget=2000,
+                 devices=None, groups=None, virtual=False, presets_path=PRESETS_PATH):
         # CC-nummer från officiella MIDI-specen
         self.lfo_cc = 71
         self.lfo_rate_cc = 3
@@ -43,101 +89,515 @@ class SubPhattyWebController:
             "2'": 64
         }
         
-        self.log_messages = []
-        self.connect_midi()
+        # Kommandon som kan styras från webben (HTTP-route och WebSocket)
+        self.commands = {
+            'lfo': self.set_lfo_wave,
+            'vco': self.set_vco_octave,
+            'lfo_rate': self.set_lfo_rate
+        }
+        
+        # Ringbuffert med sekvensnummer så att klienter kan hämta bara nya rader.
+        # Dess lås skyddar också prenumeranterna nedan.
+        self.log_buffer = LogRingBuffer(log_capacity)
+        
+        # Terminalutskrifter görs av en egen tråd, inte på sändningsvägen
+        self.log_writer = LogWriter()
+        
+        # Köer för /events-strömmar (en per öppen flik)
+        self.subscribers = set()
+        
+        # Flera HTTP-trådar delar på samma controller, så anslutningen skyddas
+        # av ett lås (loggen har sitt eget i log_buffer)
+        self.lock = threading.RLock()
+        self.started = time.monotonic()
+        
+        # En eller flera synthar (--device), var och en med egen port, kanal,
+        # ShadowState och skrivartråd. HTTP-trådarna lägger bara meddelanden
+        # i deras köer och väntar aldrig på USB.
+        self.devices = DeviceRegistry()
+        for name, patterns, channel in devices or [('sub_phatty', DEFAULT_PATTERNS, 1)]:
+            self.devices.add(SynthDevice(name, patterns, channel,
+                                         coalesce_window=coalesce_window,
+                                         ramp_rate=ramp_rate, bus_budget=bus_budget,
+                                         log=self.log, on_status=self._device_changed))
+        for name, device_names in (groups or {}).items():
+            self.devices.add_group(name, device_names)
+        
+        # Förfrågningar utan device/group går hit
+        self.device = self.devices.default
+        
+        # Namngivna patchar som laddas med minsta möjliga antal CC
+        self.presets = PresetLibrary(presets_path)
+        self.morph_cache = None     # ((från-bytes, till-bytes), Morph)
+        
+        # --virtual: en emulerad synth per enhet i stället för USB-portar
+        self.virtual_synths = {}
+        if virtual:
+            for synth in self.devices:
+                self.virtual_synths[synth.name] = VirtualSubPhatty(synth.channel)
+                self.virtual_synths[synth.name].attach(synth.supervisor)
+        
+        # Sidan är statisk, så den byggs och komprimeras en gång
+        self.page = CachedPage(self.get_html_page())
+        
+        self.devices.start()
+        for synth in self.devices:
+            if synth.is_connected():
+                synth.log("Använder MIDI-kanal %d", synth.channel + 1)
+            else:
+                synth.log("✗ Ingen Sub Phatty hittades")
+    
+    def log(self, message, *args):
+        """
+        Lägg till meddelande i loggen.
+        
+        message kan vara en %-formatsträng med args. Posten sparas som en
+        tupel och formateras först när någon läser loggen.
+        """
+        record = (time.time(), message, args)
+        with self.log_buffer.lock:
+            seq = self.log_buffer.append(record)
+            self.publish('log', {'seq': seq, 'record': record})
+        self.log_writer.write(record)  # Visa också i terminalen
+    
+    def get_log(self):
+        """Hämta en kopia av loggen"""
+        return [format_record(record) for record in self.log_buffer.snapshot()]
+    
+    def get_log_since(self, since=None):
+        """
+        Hämta loggrader nyare än sekvensnumret since.
+        
+        Returnerar (rader, senaste sekvensnummer, reset). reset är True när
+        klienten ska ersätta hela sin logg: första hämtningen, efter en
+        omstart av servern eller när rader hunnit falla bort ur bufferten.
+        """
+        records, seq, reset = self.log_buffer.since(since)
+        return [format_record(record) for record in records], seq, reset
     
-    def log(self, message):
-        """Lägg till meddelande i loggen"""
-        timestamp = time.strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        self.log_messages.append(log_entry)
-        print(log_entry)  # Visa också i terminalen
+    def clear_log(self):
+        """Rensa loggen"""
+        with self.log_buffer.lock:
+            self.log_buffer.clear()
+            self.publish('reset', {'seq': self.log_buffer.seq, 'log': []})
+    
+    def subscribe(self, since=None):
+        """
+        Prenumerera på händelser ('status', 'log', 'reset').
         
-        # Behåll bara senaste 50 meddelanden
-        if len(self.log_messages) > 50:
-            self.log_messages = self.log_messages[-50:]
+        Returnerar (kö, rader, sekvensnummer, reset) där raderna är de som
+        är nyare än since (se get_log_since). Båda tas under låset så att
+        ingen rad hamnar både i ögonblicksbilden och i kön.
+        """
+        events = queue.Queue(maxsize=256)
+        with self.log_buffer.lock:
+            self.subscribers.add(events)
+            return (events,) + self.get_log_since(since)
+    
+    def unsubscribe(self, events):
+        """Sluta prenumerera"""
+        with self.log_buffer.lock:
+            self.subscribers.discard(events)
+    
+    def publish(self, event, data):
+        """Skicka en händelse till alla prenumeranter"""
+        with self.log_buffer.lock:
+            for events in list(self.subscribers):
+                try:
+                    events.put_nowait((event, data))
+                except queue.Full:
+                    # Klienten hänger inte med, den får återansluta
+                    self.subscribers.discard(events)
+    
+    def is_connected(self):
+        """Är standardenhetens MIDI-port öppen?"""
+        return self.device.is_connected()
     
     def connect_midi(self):
-        """Anslut till Sub Phatty via MIDI"""
+        """Sök efter portarna och anslut (knappen "Återanslut MIDI")"""
+        with self.lock:
+            results = [synth.connect() for synth in self.devices]
+            return all(results)
+    
+    def _device_changed(self, device):
+        """Anropas när en enhets port öppnas eller försvinner"""
+        self.publish('status', {'connected': self.is_connected()})
+    
+    def includes_default(self, device):
+        """Går ändringar till device (enhet eller grupp) också till standardenheten?"""
         try:
-            output_ports = mido.get_output_names()
-            
-            sub_phatty_port = None
-            for port in output_ports:
-                if 'Sub Phatty' in port or 'Moog' in port:
-                    sub_phatty_port = port
-                    break
-            
-            if sub_phatty_port:
-                self.outport = mido.open_output(sub_phatty_port)
-                self.log(f"✓ Ansluten till: {sub_phatty_port}")
-                self.log("Använder MIDI-kanal 2 (som Sub Phatty Editor)")
-                return True
-            else:
-                self.log("✗ Ingen Sub Phatty hittades")
-                return False
-                
-        except Exception as e:
-            self.log(f"✗ MIDI-anslutningsfel: {e}")
+            return self.device in self.devices.resolve(device)
+        except ValueError:
             return False
     
-    def send_cc(self, cc_number, value, description=""):
-        """Skicka CC-meddelande"""
-        if not self.outport:
-            self.log("✗ Ingen MIDI-anslutning")
-            return False
-            
+    def device_status(self):
+        """Status för alla enheter"""
+        return {device.name: device.status() for device in self.devices}
+    
+    def current_patch(self, device=None):
+        """
+        Senast skickade värden för en enhet som en Patch (en grupps första
+        enhet). Kastar ValueError för okända enheter.
+        """
+        return self.devices.resolve(device)[0].patch()
+    
+    def stats(self, reset_latency=False):
+        """
+        Räknare och processtid för /stats, t.ex. för utils/web_benchmark.py.
+        
+        Räknarna gäller sedan start. Med reset_latency börjar
+        fördröjningsmätningen om efter att den lästs.
+        """
+        times = os.times()
+        devices = {}
+        for device in self.devices:
+            devices[device.name] = device.stats()
+            if reset_latency:
+                device.worker.latencies.clear()
+            synth = self.virtual_synths.get(device.name)
+            if synth:
+                devices[device.name]['virtual'] = {'messages': synth.messages,
+                                                   'bytes': synth.bytes,
+                                                   'changes': synth.changes}
+        return {
+            'uptime': time.monotonic() - self.started,
+            'cpu': {'user': times.user, 'system': times.system},
+            'threads': threading.active_count(),
+            'devices': devices
+        }
+    
+    def send_cc(self, cc_number, value, description="", coalesce=False, force=False,
+                hires=False, device=None):
+        """
+        Skicka CC-meddelande till en enhet eller grupp (device, standard är
+        första enheten).
+        
+        Värden som redan är skickade hoppas över av skrivartråden. Jämförelsen
+        görs där och inte här, eftersom ett annat värde för samma CC kan ligga
+        i kön. force skickar ändå och går förbi sammanslagningen.
+        
+        Med hires är value 0-16383 och cc_number parameterns MSB. Då skickas
+        MSB och LSB, eller bara LSB om MSB inte har ändrats.
+        """
         try:
-            msg = mido.Message('control_change',
-                             channel=self.midi_channel,
-                             control=cc_number,
-                             value=value)
-            self.outport.send(msg)
-            self.log(f"✓ {description} (CC#{cc_number}={value})")
-            return True
-        except Exception as e:
-            self.log(f"✗ Fel vid sändning: {e}")
+            synths = self.devices.resolve(device)
+        except ValueError as e:
+            self.log(f"✗ {e}")
             return False
+        
+        # Varje enhet har sin egen kö, så alla får ändringen direkt
+        results = [synth.send_cc(cc_number, value, description, coalesce=coalesce,
+                                 force=force, hires=hires)
+                   for synth in synths]
+        return all(results)
     
-    def set_lfo_wave(self, wave):
+    def set_lfo_wave(self, wave, force=False, device=None):
         """Sätt LFO våg-form"""
-        if wave not in self.lfo_values:
-            self.log(f"✗ Okänd LFO-våg: {wave}")
+        try:
+            cc_number, value, description = self.resolve_change('lfo', wave)
+        except ValueError as e:
+            self.log(f"✗ {e}")
             return False
             
-        value = self.lfo_values[wave]
-        success = self.send_cc(self.lfo_cc, value, f"LFO Wave: {wave}")
+        success = self.send_cc(cc_number, value, description, force=force, device=device)
         
         if success:
             self.log(f"🎵 LFO inställt till: {wave}")
         return success
     
-    def set_vco_octave(self, octave):
+    def set_vco_octave(self, octave, force=False, device=None):
         """Sätt VCO 1 oktav"""
-        if octave not in self.vco_values:
-            self.log(f"✗ Okänd VCO-oktav: {octave}")
+        try:
+            cc_number, value, description = self.resolve_change('vco', octave)
+        except ValueError as e:
+            self.log(f"✗ {e}")
             return False
             
-        value = self.vco_values[octave]
-        success = self.send_cc(self.vco_cc, value, f"VCO Octave: {octave}")
+        success = self.send_cc(cc_number, value, description, force=force, device=device)
         
         if success:
             self.log(f"🎵 VCO oktav inställt till: {octave}")
         return success
     
-    def set_lfo_rate(self, rate):
+    def set_lfo_rate(self, rate, force=False, device=None):
         """Sätt LFO rate (0-127)"""
-        rate_int = int(rate)
-        if rate_int < 0 or rate_int > 127:
-            self.log(f"✗ LFO rate måste vara 0-127, fick: {rate_int}")
+        try:
+            cc_number, value, description = self.resolve_change('lfo_rate', rate)
+        except ValueError as e:
+            self.log(f"✗ {e}")
             return False
             
-        success = self.send_cc(self.lfo_rate_cc, rate_int, f"LFO Rate: {rate_int}")
+        # Loggas när värdet faktiskt skickas, mellanliggande värden hoppas över
+        return self.send_cc(cc_number, value, description, coalesce=True, force=force,
+                            device=device)
+    
+    def resolve_change(self, parameter, value):
+        """
+        Översätt (parameter, värde) till (cc, värde, beskrivning).
         
-        if success:
-            self.log(f"🎵 LFO rate inställt till: {rate_int}")
+        Kastar ValueError om parametern eller värdet inte är giltigt.
+        """
+        if parameter == 'lfo':
+            if value not in self.lfo_values:
+                raise ValueError(f"Okänd LFO-våg: {value}")
+            return self.lfo_cc, self.lfo_values[value], f"LFO Wave: {value}"
+        elif parameter == 'vco':
+            if value not in self.vco_values:
+                raise ValueError(f"Okänd VCO-oktav: {value}")
+            return self.vco_cc, self.vco_values[value], f"VCO Octave: {value}"
+        elif parameter == 'lfo_rate':
+            try:
+                rate_int = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Ogiltig LFO rate: {value}")
+            if rate_int < 0 or rate_int > 127:
+                raise ValueError(f"LFO rate måste vara 0-127, fick: {rate_int}")
+            return self.lfo_rate_cc, rate_int, f"LFO Rate: {rate_int}"
+        elif parameter in PARAMETERS_BY_KEY:
+            # Övriga parametrar direkt från MIDI-specen
+            spec = PARAMETERS_BY_KEY[parameter]
+            value = resolve_value(spec, value)
+            return spec.cc_msb, value, f"{spec.name}: {value}"
+        raise ValueError(f"Okänd parameter: {parameter}")
+    
+    def resolve_hires(self, parameter, value):
+        """
+        Översätt (parameter, 14-bitars värde) till (MSB-cc, värde, beskrivning).
+        
+        Kastar ValueError om parametern saknar LSB eller värdet inte är 0-16383.
+        """
+        if parameter not in PARAMETERS_BY_KEY:
+            raise ValueError(f"Okänd parameter: {parameter}")
+        spec = PARAMETERS_BY_KEY[parameter]
+        value = resolve_hires_value(spec, value)
+        return spec.cc_msb, value, f"{spec.name}: {value}/{HIRES_MAX}"
+    
+    def apply_batch(self, changes, force=False, device=None):
+        """
+        Validera alla ändringar först och skicka dem sedan i en följd.
+        
+        changes är en lista med {'parameter': ..., 'value': ...} och
+        eventuellt 'hires': true för 14-bitars värden. Kastar ValueError
+        innan något skickas om någon ändring är ogiltig. Värden som redan är
+        skickade hoppas över om inte force anges. device är en enhet eller
+        grupp, standard är första enheten.
+        """
+        synths = self.devices.resolve(device)
+        if not isinstance(changes, list) or not changes:
+            raise ValueError("Batch måste vara en icke-tom lista")
+        
+        resolved = []
+        for change in changes:
+            if not isinstance(change, dict) or 'parameter' not in change or 'value' not in change:
+                raise ValueError(f"Ogiltig ändring: {change}")
+            # Listor och objekt från JSON går inte att slå upp (och bool är int)
+            value = change['value']
+            if (not isinstance(change['parameter'], str) or isinstance(value, bool)
+                    or not isinstance(value, (str, int))):
+                raise ValueError(f"Ogiltig ändring: {change}")
+            if change.get('hires'):
+                cc_number, value, description = self.resolve_hires(change['parameter'],
+                                                                   change['value'])
+                resolved.append((cc_number, value, description, True))
+            else:
+                resolved.append(self.resolve_change(change['parameter'], change['value'])
+                                + (False,))
+        
+        results = [synth.send_batch(resolved, force=force) for synth in synths]
+        return all(results)
+    
+    def set_parameter(self, key, value, force=False, device=None):
+        """Sätt valfri parameter från MIDI-specen (t.ex. 'filter_cutoff_frequency')"""
+        try:
+            cc_number, value, description = self.resolve_change(key, value)
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return False
+        
+        # Parametrar utan namngivna värden är rattar/sliders och slås ihop
+        continuous = not PARAMETERS_BY_KEY[key].values
+        return self.send_cc(cc_number, value, description, coalesce=continuous, force=force,
+                            device=device)
+    
+    def set_parameter_hires(self, key, value, force=False, device=None):
+        """Sätt en parameter med 14 bitars upplösning (0-16383), t.ex. för mjuka svep"""
+        try:
+            cc_number, value, description = self.resolve_hires(key, value)
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return False
+        
+        return self.send_cc(cc_number, value, description, coalesce=True, force=force, hires=True,
+                            device=device)
+    
+    def ramp_parameter(self, key, target, duration, start=None, curve='linear', hires=False,
+                       device=None):
+        """
+        Svep en parameter till target på duration sekunder.
+        
+        Utan start börjar rampen från senast skickade värde (eller hoppar
+        direkt till target om det är okänt). Med hires är värdena 0-16383.
+        device är en enhet eller grupp, standard är första enheten.
+        """
+        try:
+            if key not in PARAMETERS_BY_KEY:
+                raise ValueError(f"Okänd parameter: {key}")
+            spec = PARAMETERS_BY_KEY[key]
+            if spec.values:
+                raise ValueError(f"{spec.name} har namngivna värden och kan inte svepas")
+            if hires and spec.cc_lsb is None:
+                raise ValueError(f"{spec.name} har ingen 14-bitars CC")
+            
+            resolve = resolve_hires_value if hires else resolve_value
+            target = resolve(spec, target)
+            if start is not None:
+                start = resolve(spec, start)
+            duration = check_duration(duration)
+            
+            success = True
+            for synth in self.devices.resolve(device):
+                if not synth.can_send():
+                    synth.log("✗ Ingen MIDI-anslutning")
+                    success = False
+                    continue
+                begin = synth.ramp(spec, start, target, duration, curve, hires)
+                synth.log("🎚️ Ramp %s: %d → %d på %.2f s (%s)",
+                           spec.name, begin, target, duration, curve)
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return False
         return success
     
+    def cancel_ramp(self, key, device=None):
+        """Avbryt en pågående ramp"""
+        try:
+            if key not in PARAMETERS_BY_KEY:
+                raise ValueError(f"Okänd parameter: {key}")
+            spec = PARAMETERS_BY_KEY[key]
+            for synth in self.devices.resolve(device):
+                if synth.cancel_ramp(spec):
+                    synth.log(f"⏹️ Ramp avbruten: {spec.name}")
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return False
+        return True
+    
+    def save_preset(self, name, device=None):
+        """Spara det som senast skickades till en enhet som en preset"""
+        try:
+            name = self.presets.save(name, self.current_patch(device))
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return False
+        self.log(f"💾 Preset sparad: {name}")
+        return True
+    
+    def recall_preset(self, name, force=False, device=None):
+        """
+        Ladda en preset. Bara parametrar som skiljer sig från det som senast
+        skickades går ut, i en skur per enhet (alla med force).
+        
+        Returnerar patchen, eller None om namnet är okänt eller ingen enhet
+        kunde ta emot den.
+        """
+        try:
+            patch = self.presets.get(name)
+            synths = self.devices.resolve(device)
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return None
+        
+        success = True
+        for synth in synths:
+            changes = synth.recall(patch, f"Preset {name}", force=force)
+            if changes is None:
+                success = False
+                continue
+            synth.log("🎛️ Preset %s: %d av %d parametrar ändras",
+                      name, changes, len(patch.set_indices()))
+        return patch if success else None
+    
+    def get_morph(self, source, target):
+        """Morph mellan två presets, den senaste sparas så att en slider kan dra i den"""
+        # Nyckeln är patcharnas innehåll, så en preset som sparats om eller
+        # tagits bort aldrig ger en gammal morf (att läsa två poster är billigt)
+        start, end = self.presets.get(source), self.presets.get(target)
+        key = (bytes(start), bytes(end))
+        with self.lock:
+            if self.morph_cache and self.morph_cache[0] == key:
+                return self.morph_cache[1]
+        morph = Morph(start, end)
+        with self.lock:
+            self.morph_cache = (key, morph)
+        return morph
+    
+    def morph_presets(self, source, target, position=None, duration=None, curve='linear',
+                      device=None):
+        """
+        Morfa mellan två presets, antingen till position (0.0-1.0) direkt
+        eller från source till target på duration sekunder.
+        
+        Bara CC:er som ändras mellan två bilder skickas.
+        """
+        try:
+            morph = self.get_morph(source, target)
+            synths = self.devices.resolve(device)
+            if position is not None:
+                try:
+                    position = float(position)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Ogiltig position: {position}")
+                frame = morph.frame(position)
+                return all([synth.morph_to(frame) for synth in synths])
+            
+            duration = check_duration(duration)
+            success = True
+            for synth in synths:
+                if not synth.can_send():
+                    synth.log("✗ Ingen MIDI-anslutning")
+                    success = False
+                    continue
+                synth.start_morph(morph, duration, curve, f"{source} → {target}")
+                synth.log("🌗 Morf %s → %s på %.2f s (%s)", source, target, duration, curve)
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return False
+        return success
+    
+    def cancel_morph(self, device=None):
+        """Avbryt en pågående morf"""
+        try:
+            for synth in self.devices.resolve(device):
+                if synth.cancel_morph():
+                    synth.log("⏹️ Morf avbruten")
+        except ValueError as e:
+            self.log(f"✗ {e}")
+            return False
+        return True
+    
+    def delete_preset(self, name):
+        """Ta bort en preset"""
+        if not self.presets.delete(name):
+            self.log(f"✗ Okänd preset: {name}")
+            return False
+        self.log(f"🗑️ Preset borttagen: {name}")
+        return True
+    
+    def run_command(self, command, param, force=False, hires=False, device=None):
+        """Kör ett kommando (t.ex. 'lfo_rate', '64'), device är enhet eller grupp"""
+        if hires:
+            return self.set_parameter_hires(command, param, force=force, device=device)
+        if command not in self.commands:
+            if command in PARAMETERS_BY_KEY:
+                return self.set_parameter(command, param, force=force, device=device)
+            self.log(f"✗ Okänt kommando: {command}")
+            return False
+        try:
+            return self.commands[command](param, force=force, device=device)
+        except ValueError:
+            self.log(f"✗ Ogiltigt värde för {command}: {param}")
+            return False
+    
     def get_html_page(self):
         """Generera HTML-sidan"""
         return """
@@ -262,6 +722,15 @@ class SubPhattyWebController:
             font-size: 12px;
             line-height: 1.4;
         }
+        .preset-row {
+            display: flex;
+            gap: 10px;
+        }
+        .preset-row select {
+            flex: 1;
+            padding: 10px;
+            font-size: 16px;
+        }
         .controls {
             text-align: center;
             margin-top: 20px;
@@ -312,6 +781,14 @@ class SubPhattyWebController:
             </div>
         </div>
         
+        <div class="section">
+            <h3>Presets</h3>
+            <div class="preset-row">
+                <select id="presetList" onchange="recallPreset(this.value)"></select>
+                <button onclick="savePreset()">Spara som...</button>
+            </div>
+        </div>
+        
         <div class="section">
             <h3>Status Log</h3>
             <div id="log" class="log"></div>
@@ -326,14 +803,55 @@ class SubPhattyWebController:
 
     <script>
         let updateInterval;
+        let ws = null;
+        let events = null;
+        let logSeq = null;
+        
+        // Persistent WebSocket för parameterändringar. Ramarna är bara
+        // "namn=värde" i båda riktningarna.
+        function connectWebSocket() {
+            if (!('WebSocket' in window)) return;
+            
+            const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+            ws = new WebSocket(`${protocol}//${location.host}/ws`);
+            
+            ws.onmessage = (event) => {
+                const split = event.data.indexOf('=');
+                if (split < 0) return;
+                handleParameter(event.data.slice(0, split), event.data.slice(split + 1));
+            };
+            
+            ws.onclose = () => {
+                // Försök igen om en stund, HTTP används under tiden
+                ws = null;
+                setTimeout(connectWebSocket, 2000);
+            };
+        }
+        
+        function sendParameter(name, value) {
+            if (ws && ws.readyState === WebSocket.OPEN) {
+                ws.send(`${name}=${value}`);
+                return true;
+            }
+            return false;
+        }
+        
+        // Ändringar gjorda från en annan enhet
+        function handleParameter(name, value) {
+            if (name === 'lfo_rate') {
+                document.getElementById('lfoRate').value = value;
+                document.getElementById('lfoRateValue').textContent = value;
+            } else if (name === 'error') {
+                console.error('Parameter rejected:', value);
+            }
+        }
         
         function sendCommand(command, param) {
             fetch(`/${command}?param=${encodeURIComponent(param)}`)
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
-                        updateStatus();
-                        updateLog();
+                        refresh();
                     }
                 })
                 .catch(error => {
@@ -353,23 +871,56 @@ class SubPhattyWebController:
             // Uppdatera visningen
             document.getElementById('lfoRateValue').textContent = rate;
             
-            // Skicka till servern
+            // Skicka över WebSocket om den är öppen (några få byte per rörelse)
+            if (sendParameter('lfo_rate', rate)) {
+                return;
+            }
+            
+            // Annars som vanlig HTTP-förfrågan
             fetch('/lfo_rate?param=' + encodeURIComponent(rate))
                 .then(response => response.json())
                 .then(data => {
-                    updateLog();
+                    refresh();
                 })
                 .catch(error => {
                     console.error('Error:', error);
                 });
         }
         
+        function loadPresets(selected) {
+            fetch('/presets')
+                .then(response => response.json())
+                .then(data => {
+                    const list = document.getElementById('presetList');
+                    list.innerHTML = '<option value="">Välj preset</option>';
+                    for (const name of data.presets) {
+                        const option = document.createElement('option');
+                        option.value = option.textContent = name;
+                        list.appendChild(option);
+                    }
+                    list.value = selected || '';
+                });
+        }
+        
+        function recallPreset(name) {
+            if (name) {
+                fetch('/preset/' + encodeURIComponent(name));
+            }
+        }
+        
+        function savePreset() {
+            const name = prompt('Namn på preset:');
+            if (name) {
+                fetch('/preset/' + encodeURIComponent(name) + '?save=1')
+                    .then(() => loadPresets(name));
+            }
+        }
+        
         function reconnectMIDI() {
             fetch('/reconnect')
                 .then(response => response.json())
                 .then(data => {
-                    updateStatus();
-                    updateLog();
+                    refresh();
                 });
         }
         
@@ -377,36 +928,94 @@ class SubPhattyWebController:
             fetch('/clear_log')
                 .then(response => response.json())
                 .then(data => {
-                    updateLog();
+                    logSeq = null;
+                    refresh();
                 });
         }
         
+        function showStatus(connected) {
+            const statusEl = document.getElementById('status');
+            if (connected) {
+                statusEl.textContent = '✓ Ansluten till Sub Phatty';
+                statusEl.className = 'status connected';
+            } else {
+                statusEl.textContent = '✗ Ingen anslutning';
+                statusEl.className = 'status error';
+            }
+        }
+        
+        function showLog(lines) {
+            const logEl = document.getElementById('log');
+            logEl.textContent = lines.join('\\n');
+            logEl.scrollTop = logEl.scrollHeight;
+        }
+        
+        function appendLog(line) {
+            const logEl = document.getElementById('log');
+            logEl.textContent += (logEl.textContent ? '\\n' : '') + line;
+            logEl.scrollTop = logEl.scrollHeight;
+        }
+        
         function updateStatus() {
             fetch('/status')
                 .then(response => response.json())
                 .then(data => {
-                    const statusEl = document.getElementById('status');
-                    if (data.connected) {
-                        statusEl.textContent = '✓ Ansluten till Sub Phatty';
-                        statusEl.className = 'status connected';
-                    } else {
-                        statusEl.textContent = '✗ Ingen anslutning';
-                        statusEl.className = 'status error';
-                    }
+                    showStatus(data.connected);
                 });
         }
         
         function updateLog() {
-            fetch('/log')
-                .then(response => response.json())
+            // Hämta bara rader vi inte redan har, 304 betyder inget nytt
+            const query = logSeq === null ? '' : `?since=${logSeq}`;
+            fetch('/log' + query)
+                .then(response => response.status === 304 ? null : response.json())
                 .then(data => {
-                    const logEl = document.getElementById('log');
-                    logEl.textContent = data.log.join('\\n');
-                    logEl.scrollTop = logEl.scrollHeight;
+                    if (!data) return;
+                    if (data.reset) {
+                        showLog(data.log);
+                    } else {
+                        data.log.forEach(appendLog);
+                    }
+                    logSeq = data.seq;
                 });
         }
         
-        // Auto-uppdatera varje 2 sekunder
+        // Med /events skickar servern ändringar själv, annars hämtar vi
+        function refresh() {
+            if (!events) {
+                updateStatus();
+                updateLog();
+            }
+        }
+        
+        // Server-Sent Events: status och nya loggrader när de händer
+        function connectEvents() {
+            if (!('EventSource' in window)) {
+                startAutoUpdate();
+                return;
+            }
+            
+            events = new EventSource('/events');
+            events.addEventListener('status', (event) => {
+                showStatus(JSON.parse(event.data).connected);
+            });
+            events.addEventListener('reset', (event) => {
+                const data = JSON.parse(event.data);
+                showLog(data.log);
+                logSeq = data.seq;
+            });
+            events.addEventListener('log', (event) => {
+                const data = JSON.parse(event.data);
+                appendLog(data.line);
+                logSeq = data.seq;
+            });
+            events.onerror = () => {
+                // EventSource återansluter själv och får en ny 'reset'
+                showStatus(false);
+            };
+        }
+        
+        // Auto-uppdatera varje 2 sekunder (bara om EventSource saknas)
         function startAutoUpdate() {
             updateStatus();
             updateLog();
@@ -417,112 +1026,701 @@ class SubPhattyWebController:
         }
         
         // Starta när sidan laddas
-        window.onload = startAutoUpdate;
+        window.onload = () => {
+            connectWebSocket();
+            connectEvents();
+            loadPresets();
+        };
         
         // Stoppa auto-update när sidan lämnas
         window.onbeforeunload = () => {
             if (updateInterval) clearInterval(updateInterval);
+            if (events) events.close();
         };
     </script>
 </body>
 </html>
         """
 
+class CachedPage:
+    """
+    En färdigrenderad sida med förkomprimerade varianter och stark ETag.
+    
+    Varje kodning har sin egen ETag (RFC 9110 kräver olika starka ETags för
+    olika representationer). Med Cache-Control: no-cache frågar webbläsaren
+    alltid servern, men får 304 utan innehåll så länge sidan är oförändrad.
+    """
+    
+    def __init__(self, html, content_type='text/html; charset=utf-8'):
+        body = html.encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        
+        self.content_type = content_type
+        self.variants = {
+            'identity': (body, f'"{digest}"'),
+            'gzip': (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gzip"')
+        }
+        if brotli:
+            self.variants['br'] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+    
+    def choose_encoding(self, accept_encoding):
+        """Välj den minsta varianten som klienten accepterar"""
+        accepted = set()
+        for part in (accept_encoding or '').split(','):
+            name, _, params = part.partition(';')
+            params = params.strip().replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    if float(params[2:]) == 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(name.strip().lower())
+        
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+    
+    def is_not_modified(self, if_none_match, etag):
+        """Har klienten redan den här varianten?"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        return etag in (tag.strip() for tag in if_none_match.split(','))
+
+def encode_websocket_frame(payload, opcode=0x1):
+    """Bygg en omaskerad WebSocket-ram (server → klient)"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+class WebSocketConnection:
+    """En WebSocket-anslutning ovanpå HTTP-hanterarens socket (RFC 6455)"""
+    
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+    
+    # Parameterramar är några få byte, allt stort är fel (gäller hela
+    # meddelandet, även när det är uppdelat på flera ramar)
+    MAX_PAYLOAD = 64 * 1024
+    
+    # Stängningskoder (RFC 6455 7.4.1)
+    CLOSE_PROTOCOL_ERROR = 1002
+    CLOSE_TOO_BIG = 1009
+    
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.write_lock = threading.Lock()
+        self.closed = False
+    
+    def _read_exact(self, count):
+        data = self.rfile.read(count)
+        if len(data) < count:
+            raise ConnectionError("WebSocket stängd")
+        return data
+    
+    def _read_frame(self):
+        """Läs en ram, returnerar (fin, opcode, payload)"""
+        first, second = self._read_exact(2)
+        fin = first & 0x80
+        opcode = first & 0x0F
+        length = second & 0x7F
+        
+        if length == 126:
+            length = struct.unpack('!H', self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read_exact(8))[0]
+        if length > self.MAX_PAYLOAD:
+            self.fail(self.CLOSE_TOO_BIG, f"För stor WebSocket-ram: {length} byte")
+        if not second & 0x80:
+            # Klientramar måste vara maskade (RFC 6455 5.1)
+            self.fail(self.CLOSE_PROTOCOL_ERROR, "Omaskerad WebSocket-ram från klienten")
+        
+        mask = self._read_exact(4)
+        payload = self._read_exact(length)
+        
+        if length:
+            # XOR:a hela ramen på en gång i stället för byte för byte
+            key = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, 'big') ^
+                       int.from_bytes(key, 'big')).to_bytes(length, 'big')
+        return fin, opcode, payload
+    
+    def receive(self):
+        """Vänta på nästa text- eller binärmeddelande, None när anslutningen stängs"""
+        message = b''
+        while True:
+            fin, opcode, payload = self._read_frame()
+            
+            if opcode == self.OP_CLOSE:
+                self.close(payload[:2])
+                return None
+            elif opcode == self.OP_PING:
+                self.send_frame(encode_websocket_frame(payload, self.OP_PONG))
+                continue
+            elif opcode == self.OP_PONG:
+                continue
+            
+            if len(message) + len(payload) > self.MAX_PAYLOAD:
+                self.fail(self.CLOSE_TOO_BIG,
+                          f"För stort WebSocket-meddelande: {len(message) + len(payload)} byte")
+            message += payload
+            if fin:
+                return message
+    
+    def send_frame(self, frame):
+        """Skicka en färdigbyggd ram, False om klienten har försvunnit"""
+        with self.write_lock:
+            if self.closed:
+                return False
+            try:
+                self.wfile.write(frame)
+                return True
+            except OSError:
+                self.closed = True
+                return False
+    
+    def send_text(self, text):
+        return self.send_frame(encode_websocket_frame(text.encode('utf-8')))
+    
+    def close(self, code=b''):
+        self.send_frame(encode_websocket_frame(code, self.OP_CLOSE))
+        self.closed = True
+    
+    def fail(self, code, reason):
+        """Stäng med en felkod och avbryt läsningen"""
+        self.close(struct.pack('!H', code))
+        raise ConnectionError(reason)
+
+class WebSocketHub:
+    """Håller reda på anslutna WebSocket-klienter"""
+    
+    def __init__(self):
+        self.clients = set()
+        self.lock = threading.Lock()
+    
+    def add(self, client):
+        with self.lock:
+            self.clients.add(client)
+    
+    def remove(self, client):
+        with self.lock:
+            self.clients.discard(client)
+    
+    def __len__(self):
+        with self.lock:
+            return len(self.clients)
+    
+    def broadcast(self, text, exclude=None):
+        """Skicka samma ram till alla klienter (utom avsändaren)"""
+        frame = encode_websocket_frame(text.encode('utf-8'))
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            if client is not exclude and not client.send_frame(frame):
+                self.remove(client)
+
 class RequestHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 ger keep-alive så att en mobil inte behöver öppna en ny
+    # TCP-anslutning för varje slider-rörelse. Därför måste alla svar ha
+    # Content-Length.
+    protocol_version = 'HTTP/1.1'
+    
+    # Stäng inaktiva keep-alive-anslutningar så att de inte blockerar en
+    # arbetstråd för evigt
+    timeout = 15
+    
+    # Huvud och kropp skrivs var för sig, med Nagle väntar kroppen då på
+    # klientens fördröjda ACK (ca 40 ms per svar)
+    disable_nagle_algorithm = True
+    
+    # Sätts när anslutningen ska lämnas över till en strömtråd
+    # (BoundedThreadingHTTPServer.start_stream), som då stänger den själv
+    stream = None
+    
     def __init__(self, controller, *args, **kwargs):
         self.controller = controller
         super().__init__(*args, **kwargs)
     
+    def send_body(self, body, content_type='application/json', status=200):
+        """Skicka ett komplett svar med Content-Length"""
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_page(self, page):
+        """Skicka en CachedPage, komprimerad och med 304 om den inte ändrats"""
+        encoding = page.choose_encoding(self.headers.get('Accept-Encoding'))
+        body, etag = page.variants[encoding]
+        not_modified = page.is_not_modified(self.headers.get('If-None-Match'), etag)
+        
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if not not_modified:
+            self.send_header('Content-type', page.content_type)
+            if encoding != 'identity':
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+    
+    def send_json(self, data, status=200):
+        """Skicka ett JSON-svar"""
+        self.send_body(json.dumps(data).encode('utf-8'), status=status)
+    
     def do_GET(self):
         """Hantera GET-förfrågningar"""
+        path, _, query = self.path.partition('?')
         
         # Logga inte tillgångsförfrågningar för att hålla loggen ren
-        if self.path != '/log' and self.path != '/status':
-            print(f"Request: {self.path}")
+        if path not in QUIET_PATHS:
+            self.controller.log_writer.emit("Request: %s", self.path)
         
-        if self.path == '/':
-            # Huvudsidan
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(self.controller.get_html_page().encode('utf-8'))
-            
-        elif self.path.startswith('/lfo?'):
-            # LFO-kommando
-            params = urllib.parse.parse_qs(self.path.split('?')[1])
-            wave = params.get('param', [''])[0]
-            success = self.controller.set_lfo_wave(wave)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': success}).encode('utf-8'))
-            
-        elif self.path.startswith('/vco?'):
-            # VCO-kommando
-            params = urllib.parse.parse_qs(self.path.split('?')[1])
-            octave = params.get('param', [''])[0]
-            success = self.controller.set_vco_octave(octave)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': success}).encode('utf-8'))
-            
-        elif self.path.startswith('/lfo_rate?'):
-            # LFO Rate-kommando
-            params = urllib.parse.parse_qs(self.path.split('?')[1])
-            rate = params.get('param', [''])[0]
-            success = self.controller.set_lfo_rate(rate)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': success}).encode('utf-8'))
-            
-        elif self.path == '/reconnect':
-            # Återanslut MIDI
-            self.controller.connect_midi()
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': True}).encode('utf-8'))
-            
-        elif self.path == '/clear_log':
-            # Rensa logg
-            self.controller.log_messages.clear()
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': True}).encode('utf-8'))
-            
-        elif self.path == '/status':
-            # Status
-            connected = self.controller.outport is not None
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
+        # Query-strängen tolkas en gång här, inte i varje route
+        params = urllib.parse.parse_qs(query) if query else {}
+        force = params.get('force', [''])[0] in ('1', 'true')
+        hires = params.get('hires', [''])[0] in ('1', 'true')
+        device = params.get('device', params.get('group', ['']))[0] or None
+        
+        route = GET_ROUTES.get(path)
+        if route:
+            route(self, params)
+        elif path in COMMAND_ROUTES:
+            # Äldre kommandon: /lfo?param=..., /vco?param=..., /lfo_rate?param=...
+            self.send_success(self.apply_command(COMMAND_ROUTES[path],
+                                                 params.get('param', [''])[0],
+                                                 force=force, hires=hires, device=device))
+        elif path.startswith('/preset/'):
+            # Preset: /preset/<namn> laddar, ?save=1 sparar nuvarande värden, ?delete=1 tar bort
+            self.route_preset(urllib.parse.unquote(path[len('/preset/'):]), params, force, device)
+        elif path.startswith('/ramp/'):
+            # Ramp: /ramp/<namn>?to=...&time=...[&from=...][&curve=...][&hires=1] eller ?cancel=1
+            self.route_ramp(path[len('/ramp/'):], params, hires, device)
+        elif path.startswith('/param/'):
+            # Valfri parameter från MIDI-specen: /param/<namn>?value=...[&force=1][&hires=1]
+            # Alla förfrågningar kan ha &device=<namn> eller &group=<namn>
+            self.send_success(self.apply_command(path[len('/param/'):],
+                                                 params.get('value', [''])[0],
+                                                 force=force, hires=hires, device=device))
+        else:
+            # 404
+            self.send_body(b'', status=404)
+    
+    def send_success(self, success):
+        """Skicka ett av de färdigbyggda success-svaren"""
+        self.send_body(RESPONSE_SUCCESS if success else RESPONSE_FAILURE)
+    
+    def route_page(self, params):
+        # Huvudsidan
+        self.send_page(self.controller.page)
+    
+    def route_events(self, params):
+        # Server-Sent Events för status och logg, i en egen tråd
+        if not self.server.start_stream(self, self.handle_events):
+            self.send_stream_limit()
+    
+    def route_websocket(self, params):
+        # WebSocket för parameterändringar, i en egen tråd
+        if not self.server.start_stream(self, self.handle_websocket):
+            self.send_stream_limit()
+    
+    def send_stream_limit(self):
+        """Svara 503 när alla strömmar är upptagna (EventSource försöker igen)"""
+        self.close_connection = True
+        self.send_json({'success': False, 'error': 'För många öppna strömmar'}, status=503)
+    
+    def route_reconnect(self, params):
+        # Återanslut MIDI
+        self.controller.connect_midi()
+        self.send_success(True)
+    
+    def route_clear_log(self, params):
+        # Rensa logg
+        self.controller.clear_log()
+        self.send_success(True)
+    
+    def route_status(self, params):
+        # Status
+        self.send_json({
+            'connected': self.controller.is_connected(),
+            'devices': self.controller.device_status()
+        })
+    
+    def route_morph(self, params):
+        # Morf: /morph?from=a&to=b&position=0.5 eller &time=4[&curve=...], ?cancel=1 avbryter
+        device = params.get('device', params.get('group', ['']))[0] or None
+        if params.get('cancel', [''])[0] in ('1', 'true'):
+            self.send_success(self.controller.cancel_morph(device=device))
+            return
+        if 'position' not in params and not self.check_time(params):
+            return
+        self.send_success(self.controller.morph_presets(
+            params.get('from', [''])[0], params.get('to', [''])[0],
+            position=params.get('position', [None])[0], duration=params.get('time', ['1'])[0],
+            curve=params.get('curve', ['linear'])[0], device=device))
+    
+    def route_presets(self, params):
+        # Alla presets
+        self.send_json({'presets': self.controller.presets.names()})
+    
+    def route_preset(self, name, params, force, device):
+        if params.get('save', [''])[0] in ('1', 'true'):
+            self.send_success(self.controller.save_preset(name, device=device))
+            return
+        if params.get('delete', [''])[0] in ('1', 'true'):
+            self.send_success(self.controller.delete_preset(name))
+            return
+        
+        patch = self.controller.recall_preset(name, force=force, device=device)
+        if patch is not None and self.controller.includes_default(device):
+            # Andra sidor visar LFO rate
+            rate = patch[PARAMETERS_BY_CC[self.controller.lfo_rate_cc]]
+            if rate is not None:
+                self.server.websockets.broadcast(f"lfo_rate={rate}")
+        self.send_success(patch is not None)
+    
+    def route_patch(self, params):
+        # Senast skickade värden, /patch?device=<namn>
+        device = params.get('device', params.get('group', ['']))[0] or None
+        try:
+            patch = self.controller.current_patch(device)
+        except ValueError as e:
+            self.send_json({'success': False, 'error': str(e)}, status=400)
+            return
+        self.send_json({'patch': patch.to_dict()})
+    
+    def route_stats(self, params):
+        # Räknare för benchmarks, /stats?reset=1 nollställer fördröjningarna
+        stats = self.controller.stats(reset_latency=params.get('reset', [''])[0] in ('1', 'true'))
+        stats['websockets'] = len(self.server.websockets)
+        self.send_json(stats)
+    
+    def route_log(self, params):
+        # Logg-meddelanden, /log?since=N ger bara rader efter sekvensnummer N
+        since = parse_int(params.get('since', [None])[0])
+        lines, seq, reset = self.controller.get_log_since(since)
+        
+        if not lines and not reset:
+            # Inget nytt
+            self.send_response(304)
             self.end_headers()
-            self.wfile.write(json.dumps({'connected': connected}).encode('utf-8'))
+            return
+        self.send_json({'log': lines, 'seq': seq, 'reset': reset})
+    
+    def route_ramp(self, key, params, hires, device):
+        if params.get('cancel', [''])[0] in ('1', 'true'):
+            self.send_success(self.controller.cancel_ramp(key, device=device))
+            return
+        if not self.check_time(params):
+            return
+        self.send_success(self.controller.ramp_parameter(
+            key, params.get('to', [''])[0], params.get('time', ['1'])[0],
+            start=params.get('from', [None])[0], curve=params.get('curve', ['linear'])[0],
+            hires=hires, device=device))
+    
+    def check_time(self, params):
+        """Svarar 400 och returnerar False om ?time= inte är en giltig tid"""
+        try:
+            check_duration(params.get('time', ['1'])[0])
+        except ValueError as e:
+            self.send_json({'success': False, 'error': str(e)}, status=400)
+            return False
+        return True
+    
+    def route_params(self, params):
+        # Alla parametrar från MIDI-specen (byggd en gång vid start)
+        self.send_body(RESPONSE_PARAMETERS)
+    
+    def apply_command(self, command, param, origin=None, force=False, hires=False, device=None):
+        """Kör kommandot och berätta för övriga WebSocket-klienter"""
+        success = self.controller.run_command(command, param, force=force, hires=hires,
+                                              device=device)
+        # Sidan visar standardenheten
+        if success and self.controller.includes_default(device):
+            if hires:
+                # Sidorna visar 7-bitarsvärden
+                param = int(param) >> 7
+            self.server.websockets.broadcast(f"{command}={param}", exclude=origin)
+        return success
+    
+    def send_event(self, event, data, event_id=None):
+        """Skriv en SSE-händelse"""
+        id_line = f"id: {event_id}\n" if event_id is not None else ""
+        self.wfile.write(f"event: {event}\n{id_line}data: {json.dumps(data)}\n\n".encode('utf-8'))
+    
+    def handle_events(self):
+        """Håll en text/event-stream öppen och skicka händelser när de sker"""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        
+        # Strömmen har ingen längd, så anslutningen avslutas när den stängs
+        self.connection.settimeout(None)
+        self.close_connection = True
+        
+        # EventSource skickar Last-Event-ID när den återansluter, då räcker
+        # det med raderna som kommit sedan dess
+        since = parse_int(self.headers.get('Last-Event-ID'))
+        events, lines, seq, reset = self.controller.subscribe(since)
+        try:
+            self.send_event('status', {'connected': self.controller.is_connected()})
+            if reset:
+                self.send_event('reset', {'seq': seq, 'log': lines}, event_id=seq)
+            else:
+                for offset, line in enumerate(lines):
+                    line_seq = seq - len(lines) + 1 + offset
+                    self.send_event('log', {'seq': line_seq, 'line': line}, event_id=line_seq)
             
-        elif self.path == '/log':
-            # Logg-meddelanden
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'log': self.controller.log_messages}).encode('utf-8'))
+            while True:
+                try:
+                    event, data = events.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    if events not in self.controller.subscribers:
+                        break  # Utkastad p.g.a. full kö
+                    # Kommentarrad så att döda anslutningar upptäcks
+                    self.wfile.write(b': keepalive\n\n')
+                    continue
+                if event == 'log':
+                    # Formateras här i stället för i tråden som loggade
+                    data = {'seq': data['seq'], 'line': format_record(data['record'])}
+                self.send_event(event, data, event_id=data.get('seq'))
+        except OSError:
+            pass
+        finally:
+            self.controller.unsubscribe(events)
+    
+    def handle_websocket(self):
+        """Uppgradera anslutningen till WebSocket och ta emot namn=värde-ramar"""
+        key = self.headers.get('Sec-WebSocket-Key')
+        if 'websocket' not in self.headers.get('Upgrade', '').lower() or not key:
+            self.send_body(b'', status=400)
+            return
+        
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        
+        # Anslutningen lever så länge sidan är öppen
+        self.connection.settimeout(None)
+        self.close_connection = True
+        
+        client = WebSocketConnection(self.rfile, self.wfile)
+        self.server.websockets.add(client)
+        try:
+            while True:
+                message = client.receive()
+                if message is None:
+                    break
+                
+                command, _, param = message.decode('utf-8', 'replace').partition('=')
+                if not self.apply_command(command, param, origin=client):
+                    client.send_text(f"error={command}")
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.websockets.remove(client)
+    
+    def do_POST(self):
+        """Hantera POST-förfrågningar"""
+        self.controller.log_writer.emit("Request: POST %s", self.path)
+        
+        # Kroppen läses med exakt längd, annars kan en klient hålla kvar arbetaren
+        header = self.headers.get('Content-Length')
+        if header is None:
+            self.close_connection = True
+            self.send_json({'success': False, 'error': 'Content-Length saknas'}, status=411)
+            return
+        try:
+            length = int(header)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_json({'success': False, 'error': f"Ogiltig Content-Length: {header}"},
+                           status=400)
+            return
+        if length > MAX_POST_BODY:
+            self.close_connection = True
+            self.send_json({'success': False, 'error': 'För stor förfrågan'}, status=413)
+            return
+        body = self.rfile.read(length)
+        
+        if self.path == '/batch':
+            # Flera parameterändringar i en förfrågan
+            try:
+                payload = json.loads(body or b'null')
+                if isinstance(payload, dict):
+                    changes = payload.get('changes')
+                    force = bool(payload.get('force'))
+                    device = payload.get('device') or payload.get('group')
+                else:
+                    changes, force, device = payload, False, None
+                success = self.controller.apply_batch(changes, force=force, device=device)
+            except ValueError as e:
+                self.send_json({'success': False, 'error': str(e)}, status=400)
+                return
             
+            if success and self.controller.includes_default(device):
+                for change in changes:
+                    value = int(change['value']) >> 7 if change.get('hires') else change['value']
+                    self.server.websockets.broadcast(f"{change['parameter']}={value}")
+            self.send_json({'success': success, 'count': len(changes)})
         else:
-            # 404
-            self.send_response(404)
-            self.end_headers()
+            self.send_body(b'', status=404)
+    
+    def finish(self):
+        if self.stream is None:
+            super().finish()
+    
+    def close_stream(self):
+        """Stäng en överlämnad anslutning, anropas av strömtråden"""
+        super().finish()
     
     def log_message(self, format, *args):
         """Stäng av HTTP-server loggning"""
         pass
 
+class BoundedThreadingHTTPServer(http.server.HTTPServer):
+    """
+    HTTP-server som hanterar varje anslutning i en trådpool.
+    
+    Till skillnad från ThreadingMixIn startas inte en ny tråd per anslutning,
+    utan antalet samtidiga arbetare är begränsat. Anslutningar utöver det
+    väntar i kön tills en arbetare blir ledig. Arbetarna är daemon-trådar så
+    att Ctrl+C inte hänger på öppna keep-alive-anslutningar.
+    
+    Strömmar som lever så länge sidan är öppen (/events, /ws) lämnas över
+    till en egen tråd, högst max_streams samtidigt, så att poolen alltid är
+    ledig för korta förfrågningar.
+    """
+    allow_reuse_address = True
+    
+    def __init__(self, server_address, handler_class, max_workers=32, max_streams=MAX_STREAMS):
+        self.requests = queue.SimpleQueue()
+        self.websockets = WebSocketHub()
+        self.streams = threading.BoundedSemaphore(max_streams)
+        super().__init__(server_address, handler_class)
+        
+        self.workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self.worker_loop,
+                                      name=f"http-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def process_request(self, request, client_address):
+        """Lämna över anslutningen till trådpoolen"""
+        self.requests.put((request, client_address))
+    
+    def finish_request(self, request, client_address):
+        """Som i socketserver, men returnerar hanteraren"""
+        return self.RequestHandlerClass(request, client_address, self)
+    
+    def worker_loop(self):
+        """Körs i varje arbetstråd (samma felhantering som ThreadingMixIn)"""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            
+            if getattr(handler, 'stream', None) is None:
+                self.shutdown_request(request)
+            else:
+                # Tråden startas först här, när arbetaren är klar med anslutningen
+                threading.Thread(target=self.stream_loop, args=(handler,),
+                                 name=f"http-stream-{client_address[1]}", daemon=True).start()
+    
+    def start_stream(self, handler, run):
+        """
+        Låt run (som läser och skriver handlerns anslutning tills den
+        stängs) köras i en egen tråd när förfrågan är klar, i stället för i
+        arbetaren. False om max_streams strömmar redan är öppna.
+        """
+        if not self.streams.acquire(blocking=False):
+            return False
+        # Arbetaren får inte läsa fler förfrågningar från anslutningen
+        handler.close_connection = True
+        handler.stream = run
+        return True
+    
+    def stream_loop(self, handler):
+        try:
+            handler.stream()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            try:
+                handler.close_stream()
+            except OSError:
+                pass
+            self.shutdown_request(handler.request)
+            self.streams.release()
+    
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+
+# Route-tabeller för do_GET, slås upp i en dict i stället för en if/elif-kedja
+GET_ROUTES = {
+    '/': RequestHandler.route_page,
+    '/events': RequestHandler.route_events,
+    '/ws': RequestHandler.route_websocket,
+    '/reconnect': RequestHandler.route_reconnect,
+    '/clear_log': RequestHandler.route_clear_log,
+    '/status': RequestHandler.route_status,
+    '/stats': RequestHandler.route_stats,
+    '/patch': RequestHandler.route_patch,
+    '/presets': RequestHandler.route_presets,
+    '/morph': RequestHandler.route_morph,
+    '/log': RequestHandler.route_log,
+    '/params': RequestHandler.route_params
+}
+
+COMMAND_ROUTES = {
+    '/lfo': 'lfo',
+    '/vco': 'vco',
+    '/lfo_rate': 'lfo_rate'
+}
+
+# Förfrågningar som sidan gör hela tiden och som inte skrivs ut
+QUIET_PATHS = {'/log', '/status', '/events', '/stats'}
+
+def parse_int(text):
+    """Tolka ett heltal från en query-parameter eller header, None om det saknas"""
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
 def get_local_ip():
     """Hämta lokal IP-adress"""
     try:
@@ -535,31 +1733,99 @@ def get_local_ip():
     except:
         return "192.168.1.xxx"  # Fallback om det misslyckas
 
-def run_web_server(controller, port=8080):
+def run_web_server(controller, port=8080, max_workers=32, open_browser=True,
+                   max_streams=MAX_STREAMS):
     """Starta webbservern"""
     
     handler = lambda *args, **kwargs: RequestHandler(controller, *args, **kwargs)
     local_ip = get_local_ip()
     
-    with socketserver.TCPServer(("", port), handler) as httpd:
+    with BoundedThreadingHTTPServer(("", port), handler, max_workers=max_workers,
+                                    max_streams=max_streams) as httpd:
         print(f"\n🌐 Sub Phatty Web Controller startad!")
         print(f"� På denna Mac: http://localhost:{port}")
         print(f"📱 Från iPhone/iPad: http://{local_ip}:{port}")
+        print(f"👥 Upp till {max_workers} samtidiga förfrågningar och {max_streams} öppna strömmar")
         print(f"⏹️  Tryck Ctrl+C för att avsluta\n")
         
         # Försök öppna webbläsare automatiskt
-        try:
-            webbrowser.open(f'http://localhost:{port}')
-        except:
-            pass  # Inte så viktigt om det misslyckas
+        if open_browser:
+            try:
+                webbrowser.open(f'http://localhost:{port}')
+            except:
+                pass  # Inte så viktigt om det misslyckas
             
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\n🛑 Stänger ner server...")
-            if controller.outport:
-                controller.outport.close()
+            controller.devices.close()
+            controller.presets.close()
+            controller.log_writer.close()
+
+def parse_args():
+    """Läs kommandoradsargument"""
+    parser = argparse.ArgumentParser(description="Sub Phatty Web Controller")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="HTTP-port (standard: 8080)")
+    parser.add_argument('--workers', type=int, default=32,
+                        help="Max antal samtidiga förfrågningar (standard: 32)")
+    parser.add_argument('--max-streams', type=int, default=MAX_STREAMS,
+                        help=f"Max antal öppna /events- och /ws-strömmar, två per sida "
+                             f"(standard: {MAX_STREAMS})")
+    parser.add_argument('--coalesce-ms', type=float, default=20,
+                        help="Fönster för sammanslagning av slider-värden i ms, 0 = av (standard: 20)")
+    parser.add_argument('--log-capacity', type=int, default=50,
+                        help="Antal loggrader som sparas (standard: 50)")
+    parser.add_argument('--device', action='append', default=[], metavar='NAMN=PORT[@KANAL]',
+                        help="En synth: namn, del av portnamnet och MIDI-kanal 1-16 (standard: 2). "
+                             "Kan anges flera gånger, den första är standard.")
+    parser.add_argument('--group', action='append', default=[], metavar='NAMN=ENHET,ENHET',
+                        help="En grupp av enheter som kan styras med &group=NAMN "
+                             "('all' finns alltid)")
+    parser.add_argument('--ramp-rate', type=float, default=100,
+                        help="Steg per sekund för ramper (standard: 100)")
+    parser.add_argument('--bus-budget', type=int, default=2000,
+                        help="Max byte/s som ramper får använda på MIDI-länken, 0 = obegränsat "
+                             "(standard: 2000 av ca 3125)")
+    parser.add_argument('--presets', default=PRESETS_PATH,
+                        help="Fil med presets (standard: presets.bin bredvid programmet)")
+    parser.add_argument('--no-browser', action='store_true',
+                        help="Öppna inte webbläsaren vid start")
+    parser.add_argument('--virtual', action='store_true',
+                        help="Kör mot en emulerad Sub Phatty i stället för USB (för test utan hårdvara)")
+    args = parser.parse_args()
+    if not args.ramp_rate > 0:
+        raise SystemExit(f"✗ --ramp-rate måste vara > 0 steg/s, fick: {args.ramp_rate}")
+    if args.bus_budget < 0:
+        raise SystemExit(f"✗ --bus-budget kan inte vara negativ, fick: {args.bus_budget}")
+    return args
+
+def parse_groups(specs):
+    """--group NAMN=ENHET,ENHET -> {namn: [enhet, ...]}"""
+    groups = {}
+    for spec in specs:
+        name, separator, members = spec.partition('=')
+        if not separator or not name.strip():
+            raise ValueError(f"Ogiltig grupp: {spec} (NAMN=ENHET,ENHET)")
+        groups[name.strip()] = [member.strip() for member in members.split(',') if member.strip()]
+    return groups
 
 if __name__ == "__main__":
-    controller = SubPhattyWebController()
-    run_web_server(controller)
\ No newline at end of file
+    args = parse_args()
+    try:
+        devices = [parse_device_spec(spec) for spec in args.device]
+        devices = [(name, (pattern,), channel) for name, pattern, channel in devices] or None
+        groups = parse_groups(args.group)
+        controller = SubPhattyWebController(coalesce_window=args.coalesce_ms / 1000,
+                                            log_capacity=args.log_capacity,
+                                            ramp_rate=args.ramp_rate,
+                                            bus_budget=args.bus_budget,
+                                            devices=devices,
+                                            groups=groups,
+                                            virtual=args.virtual,
+                                            presets_path=args.presets)
+    except ValueError as e:
+        raise SystemExit(f"✗ {e}")
+    run_web_server(controller, port=args.port, max_workers=args.workers,
+                   open_browser=not args.no_browser, max_streams=args.max_streams)
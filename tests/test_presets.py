@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Tester för Patch och PresetLibrary: spara, skriva över, öppna igen,
+packning och en halvskriven sista post.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sub_phatty_patch import PATCH_SIZE, UNSET, Patch
+from sub_phatty_presets import (COMPACT_MIN_DELETED, HEADER, MAX_NAME_LENGTH, RECORD_SIZE,
+                                PresetLibrary)
+
+def make_patch(cutoff, glide='Off'):
+    return Patch.from_values({'filter_cutoff_frequency': cutoff, 'glide_on_off': glide})
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'presets.bin')
+
+def test_patch_values_and_diff():
+    a = make_patch(20)
+    b = make_patch(100, 'On')
+    assert a['filter_cutoff_frequency'] == 20
+    assert a['lfo_rate'] is None
+    assert len(a.diff(b)) == 2
+    assert [parameter.key for parameter, _ in a.changes(b)] == ['filter_cutoff_frequency',
+                                                                'glide_on_off']
+    assert a.diff(a.snapshot()) == []
+
+def test_patch_snapshot_is_copy_on_write():
+    patch = make_patch(20)
+    snapshot = patch.snapshot()
+    patch['filter_cutoff_frequency'] = 90
+    assert snapshot['filter_cutoff_frequency'] == 20
+
+def test_patch_rejects_bytes_that_are_not_midi_data():
+    data = bytearray([UNSET]) * PATCH_SIZE
+    data[0] = 0x90
+    with pytest.raises(ValueError):
+        Patch(data)
+    with pytest.raises(ValueError):
+        Patch(bytes(PATCH_SIZE - 1))
+
+def test_save_and_reopen(path):
+    library = PresetLibrary(path)
+    assert not os.path.exists(path)  # Filen skapas först vid första save
+    library.save(' lead ', make_patch(80))
+    library.save('pad', make_patch(20, 'On'))
+    library.close()
+
+    library = PresetLibrary(path)
+    assert library.names() == ['lead', 'pad']
+    assert library.get('lead') == make_patch(80)
+    assert library.get('pad')['glide_on_off'] == 64
+    assert library.search('LE') == ['lead']
+    library.close()
+
+def test_overwrite_and_delete(path):
+    library = PresetLibrary(path)
+    library.save('lead', make_patch(80))
+    library.save('lead', make_patch(10))
+    assert library.get('lead')['filter_cutoff_frequency'] == 10
+    assert library.delete('lead')
+    assert not library.delete('lead')
+    with pytest.raises(ValueError):
+        library.get('lead')
+    library.close()
+
+    library = PresetLibrary(path)
+    assert library.names() == []
+    assert library.deleted == 2
+    library.close()
+
+def test_compaction(path):
+    library = PresetLibrary(path)
+    library.save('keep', make_patch(1))
+    for value in range(COMPACT_MIN_DELETED + 1):
+        library.save('churn', make_patch(value))
+    library.delete('churn')
+    # Borttagna poster blev fler än giltiga, filen packades om
+    assert library.deleted < COMPACT_MIN_DELETED
+    assert os.path.getsize(path) <= HEADER.size + (library.deleted + 1) * RECORD_SIZE
+    assert library.get('keep') == make_patch(1)
+    library.close()
+
+    library = PresetLibrary(path)
+    assert library.names() == ['keep']
+    library.close()
+
+def test_torn_trailing_record_is_skipped(path):
+    library = PresetLibrary(path)
+    library.save('lead', make_patch(80))
+    library.close()
+    with open(path, 'ab') as f:
+        f.write(b'\x01torn')  # Avbruten skrivning
+
+    library = PresetLibrary(path)
+    assert library.names() == ['lead']
+    # Nästa post skriver över den halva
+    library.save('pad', make_patch(20))
+    library.close()
+    assert os.path.getsize(path) == HEADER.size + 2 * RECORD_SIZE
+    assert PresetLibrary(path).names() == ['lead', 'pad']
+
+def test_invalid_names(path):
+    library = PresetLibrary(path)
+    with pytest.raises(ValueError):
+        library.save('  ', make_patch(1))
+    with pytest.raises(ValueError):
+        library.save('x' * (MAX_NAME_LENGTH + 1), make_patch(1))
+    library.close()
+
+def test_corrupt_record_is_rejected(path):
+    library = PresetLibrary(path)
+    library.save('lead', make_patch(80))
+    library.close()
+    with open(path, 'r+b') as f:
+        f.seek(HEADER.size + 1 + MAX_NAME_LENGTH)
+        f.write(b'\x90')
+
+    library = PresetLibrary(path)
+    with pytest.raises(ValueError):
+        library.get('lead')
+    library.close()
+
+def test_not_a_preset_file(path):
+    with open(path, 'wb') as f:
+        f.write(b'not a preset file')
+    with pytest.raises(ValueError):
+        PresetLibrary(path)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Tester för RawMidiOutput: direkt till python-rtmidi när mido-porten har
+_rt.send_message, annars via port.send med ett mido.Message.
+"""
+
+import os
+import sys
+
+import mido
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sub_phatty_midi import RawMidiOutput, control_change
+
+class FakeRtMidi:
+    """Som rtmidi.MidiOut, tar listor/tupler av byte"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, data):
+        self.sent.append(tuple(data))
+
+class FakeRtMidiPort:
+    """Som mido:s rtmidi-port, med det privata _rt"""
+
+    def __init__(self):
+        self._rt = FakeRtMidi()
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+class FakePort:
+    """En port utan _rt, t.ex. en annan mido-backend"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+def test_rtmidi_port_sends_bytes_directly():
+    port = FakeRtMidiPort()
+    output = RawMidiOutput(port)
+    output.send(control_change(1, 74, 32))
+    output.send(mido.Message('control_change', channel=1, control=71, value=16))
+    assert port._rt.sent == [(0xB1, 74, 32), (0xB1, 71, 16)]
+    assert port.sent == []
+
+def test_port_without_rt_falls_back_to_mido():
+    port = FakePort()
+    output = RawMidiOutput(port)
+    output.send_burst([control_change(0, 74, 32), control_change(0, 71, 16)])
+    assert [message.bytes() for message in port.sent] == [[0xB0, 74, 32], [0xB0, 71, 16]]
+
+def test_rt_without_send_message_falls_back_to_mido():
+    port = FakePort()
+    port._rt = object()  # Annan mido-version, _rt finns men ser annorlunda ut
+    output = RawMidiOutput(port)
+    output.send(control_change(0, 74, 48))
+    assert [message.bytes() for message in port.sent] == [[0xB0, 74, 48]]
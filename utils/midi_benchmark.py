@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Mikrobenchmark för MIDI-utgången
+
+Jämför att skicka CC via mido.Message (som web-controllern gjorde förut)
+med den råa vägen i sub_phatty_midi (control_change + RawMidiOutput).
+Mäter meddelanden per sekund och minne som allokeras per sändning.
+Ingen synth behövs, porten är en attrapp som beter sig som mido:s
+rtmidi-port men inte skickar något.
+
+Med --virtual mäts också vägen till den emulerade Sub Phattyn, utan
+länkens hastighet (tolkningens kostnad) och med den (31.25 kbaud).
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import mido
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sub_phatty_midi import RawMidiOutput, control_change
+from sub_phatty_virtual import VirtualSubPhatty
+
+class NullRtMidi:
+    """Står för python-rtmidi:s MidiOut"""
+
+    def __init__(self):
+        self.count = 0
+
+    def send_message(self, message):
+        self.count += 1
+
+class NullRtMidiPort:
+    """Som mido.backends.rtmidi.Output: lås + msg.bytes() till rtmidi"""
+
+    def __init__(self):
+        self._rt = NullRtMidi()
+        self._send_lock = threading.RLock()
+
+    def send(self, msg):
+        with self._send_lock:
+            self._rt.send_message(msg.bytes())
+
+class NullStreamPort:
+    """En byteström (DIN/seriell), tar emot skurar med running status"""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write_bytes(self, data):
+        self.bytes_written += len(data)
+
+def send_mido(port, channel, i):
+    port.send(mido.Message('control_change', channel=channel, control=74, value=i & 127))
+
+def send_raw(output, channel, i):
+    output.send(control_change(channel, 74, i & 127))
+
+def measure_rate(send, target, count, channel=1):
+    """Meddelanden per sekund"""
+    start = time.perf_counter()
+    for i in range(count):
+        send(target, channel, i)
+    return count / (time.perf_counter() - start)
+
+def measure_allocations(send, target, count, channel=1):
+    """Genomsnittligt antal byte som allokeras (toppen) per sändning"""
+    tracemalloc.start()
+    total = 0
+    try:
+        for i in range(count):
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            send(target, channel, i)
+            total += tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return total / count
+
+def measure_burst(size, bursts):
+    """Byte per meddelande för skurar med och utan running status"""
+    port = NullStreamPort()
+    output = RawMidiOutput(port)
+    messages = [control_change(1, cc, 64) for cc in range(size)]
+    for _ in range(bursts):
+        output.send_burst(messages)
+    return port.bytes_written / (size * bursts)
+
+def measure_virtual(count, wire_timing):
+    """Meddelanden per sekund till en virtuell Sub Phatty"""
+    synth = VirtualSubPhatty(wire_timing=wire_timing)
+    output = RawMidiOutput(synth.open_output())
+    rate = measure_rate(send_raw, output, count)
+    return rate, synth.changes
+
+def main():
+    parser = argparse.ArgumentParser(description="Jämför mido.Message med rå MIDI-utgång")
+    parser.add_argument('--count', type=int, default=200000,
+                        help='Antal meddelanden för hastighetsmätningen (standard: 200000)')
+    parser.add_argument('--alloc-count', type=int, default=2000,
+                        help='Antal meddelanden för minnesmätningen (standard: 2000)')
+    parser.add_argument('--virtual', action='store_true',
+                        help='Mät även mot en virtuell Sub Phatty')
+    args = parser.parse_args()
+
+    port = NullRtMidiPort()
+    raw = RawMidiOutput(port)
+
+    # Värm upp så att mido:s uppslag och cacher är på plats
+    measure_rate(send_mido, port, 1000)
+    measure_rate(send_raw, raw, 1000)
+
+    print("=== MIDI-utgång: mido.Message mot rå byte ===\n")
+    results = []
+    for name, send, target in [("mido.Message", send_mido, port),
+                               ("rå (control_change)", send_raw, raw)]:
+        rate = measure_rate(send, target, args.count)
+        allocated = measure_allocations(send, target, args.alloc_count)
+        results.append(rate)
+        print(f"{name:22} {rate:12,.0f} medd/s   {allocated:8.1f} byte allokerat/medd")
+
+    print(f"\nRå väg: {results[1] / results[0]:.1f}x snabbare")
+    print(f"Running status, skur om 8 CC: {measure_burst(8, 1000):.2f} byte/medd (3.00 utan)")
+
+    if args.virtual:
+        print("\n=== Virtuell Sub Phatty ===\n")
+        rate, changes = measure_virtual(args.count, wire_timing=False)
+        print(f"{'utan länktid':22} {rate:12,.0f} medd/s   {changes} ändringar")
+        rate, changes = measure_virtual(min(args.count, 1000), wire_timing=True)
+        print(f"{'31.25 kbaud':22} {rate:12,.0f} medd/s   {changes} ändringar")
+
+if __name__ == "__main__":
+    main()
@@ -2,47 +2,36 @@
 """
 MIDI-felsökningsverktyg för Sub Phatty
 Testar olika CC-nummer och visar detaljerad information
+
+Med --virtual körs testerna mot en emulerad Sub Phatty som skriver ut vilka
+parametrar som ändrades (den lyssnar på kanal 2, som den riktiga).
 """
 
 import mido
+import os
+import sys
 import time
 
-def test_midi_connection():
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sub_phatty_virtual import VirtualSubPhatty
+
+def open_virtual():
+    """Öppna en emulerad Sub Phatty som skriver ut sitt eko"""
+    synth = VirtualSubPhatty()
+    synth.open_input(callback=lambda msg: print(f"[eko: {msg}]", end=" "))
+    print(f"✅ Ansluten till: {synth.name}")
+    return synth.open_output()
+
+def test_midi_connection(virtual=False):
     """Testa MIDI-anslutning och visa detaljerad information"""
     print("=== Sub Phatty MIDI Felsökning ===\n")
     
-    # Lista alla MIDI-portar
-    output_ports = mido.get_output_names()
-    input_ports = mido.get_input_names()
-    
-    print("MIDI-utgångar:")
-    for i, port in enumerate(output_ports):
-        print(f"  {i}: {port}")
-    
-    print("\nMIDI-ingångar:")
-    for i, port in enumerate(input_ports):
-        print(f"  {i}: {port}")
-    
-    # Hitta Sub Phatty
-    sub_phatty_out = None
-    for port in output_ports:
-        if 'sub phatty' in port.lower() or 'moog' in port.lower():
-            sub_phatty_out = port
-            break
-    
-    if not sub_phatty_out:
-        print("\n❌ Ingen Sub Phatty hittad i MIDI-utgångarna!")
-        return
-    
-    print(f"\n✅ Hittade Sub Phatty: {sub_phatty_out}")
-    
-    # Anslut
-    try:
-        midi_out = mido.open_output(sub_phatty_out)
-        print("✅ MIDI-utgång öppnad")
-    except Exception as e:
-        print(f"❌ Kunde inte öppna MIDI-utgång: {e}")
-        return
+    if virtual:
+        midi_out = open_virtual()
+    else:
+        midi_out = open_sub_phatty()
+        if not midi_out:
+            return
     
     # Testa olika MIDI-kanaler och CC-nummer
     print("\n=== Testar MIDI-kommunikation ===")
@@ -103,11 +92,44 @@ def test_midi_connection():
     
     midi_out.close()
 
-def interactive_test():
-    """Interaktiv testning av specifika CC-nummer"""
-    print("\n=== Interaktiv MIDI-test ===")
+def open_sub_phatty():
+    """Lista portarna och öppna Sub Phatty, None om den inte hittas"""
+    # Lista alla MIDI-portar
+    output_ports = mido.get_output_names()
+    input_ports = mido.get_input_names()
+    
+    print("MIDI-utgångar:")
+    for i, port in enumerate(output_ports):
+        print(f"  {i}: {port}")
+    
+    print("\nMIDI-ingångar:")
+    for i, port in enumerate(input_ports):
+        print(f"  {i}: {port}")
+    
+    # Hitta Sub Phatty
+    sub_phatty_out = None
+    for port in output_ports:
+        if 'sub phatty' in port.lower() or 'moog' in port.lower():
+            sub_phatty_out = port
+            break
     
-    # Anslut till Sub Phatty
+    if not sub_phatty_out:
+        print("\n❌ Ingen Sub Phatty hittad i MIDI-utgångarna!")
+        return None
+    
+    print(f"\n✅ Hittade Sub Phatty: {sub_phatty_out}")
+    
+    # Anslut
+    try:
+        midi_out = mido.open_output(sub_phatty_out)
+        print("✅ MIDI-utgång öppnad")
+    except Exception as e:
+        print(f"❌ Kunde inte öppna MIDI-utgång: {e}")
+        return None
+    return midi_out
+
+def connect_sub_phatty():
+    """Öppna Sub Phatty utan att lista portarna, None om den inte hittas"""
     output_ports = mido.get_output_names()
     sub_phatty_out = None
     for port in output_ports:
@@ -117,13 +139,25 @@ def interactive_test():
     
     if not sub_phatty_out:
         print("Ingen Sub Phatty hittad!")
-        return
+        return None
     
     try:
         midi_out = mido.open_output(sub_phatty_out)
     except Exception as e:
         print(f"Kunde inte ansluta: {e}")
-        return
+        return None
+    return midi_out
+
+def interactive_test(virtual=False):
+    """Interaktiv testning av specifika CC-nummer"""
+    print("\n=== Interaktiv MIDI-test ===")
+    
+    if virtual:
+        midi_out = open_virtual()
+    else:
+        midi_out = connect_sub_phatty()
+        if not midi_out:
+            return
     
     print("Skriv kommandon i formatet: kanal cc_nummer värde")
     print("Exempel: 1 24 2  (skicka CC 24 med värde 2 på kanal 1)")
@@ -171,8 +205,9 @@ def interactive_test():
     midi_out.close()
 
 if __name__ == "__main__":
-    test_midi_connection()
+    virtual = '--virtual' in sys.argv
+    test_midi_connection(virtual)
     
     answer = input("\nVill du köra interaktiv test också? (j/n): ").strip().lower()
     if answer in ['j', 'ja', 'y', 'yes']:
-        interactive_test()
\ No newline at end of file
+        interactive_test(virtual)
\ No newline at end of file
@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 """
 Sub Phatty Controller - Persistent version
-Håller inställningar genom kontinuerlig sändning
+Håller inställningar genom att lyssna på synthens MIDI-ut
+
+Låsta parametrar skickas en gång. Därefter läses synthens ingångsport och
+bara när en CC, ett programbyte eller en SysEx-patch ändrar en låst
+parameter skickas det låsta värdet igen, direkt. Så länge allt stämmer
+går ingenting på bussen.
+
+Med --virtual körs den mot en emulerad Sub Phatty.
 """
 
 import mido
-import time
+import os
 import threading
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sub_phatty_params import PARAMETERS_BY_CC
+from sub_phatty_virtual import SYSEX_HEADER, SYSEX_PATCH, VirtualSubPhatty
+
 class PersistentSubPhattyController:
-    def __init__(self):
+    def __init__(self, virtual=False):
+        self.virtual = virtual
         self.midi_out = None
+        self.midi_in = None
+        self.input_name = None
+        self.synth = None       # VirtualSubPhatty med --virtual
         self.running = False
+        self.channel = 0
         
         # MIDI CC-nummer
         self.MODULATION_SOURCE_CC = 71
@@ -29,11 +45,21 @@ class PersistentSubPhattyController:
         self.vco_octave_values = [16, 32, 48, 64]
         self.vco_octave_names = ["16'", "8'", "4'", "2'"]
         
-        # Thread för kontinuerlig sändning
-        self.sender_thread = None
+        # Låsta värden {cc: värde}, bara medan vakten är på
+        self.pinned = {}
+        self.corrections = 0
+        # Vaktens anrop kommer från ingångens tråd (med --virtual från
+        # sändningen själv, när emulatorn ekar direkt)
+        self.lock = threading.RLock()
     
     def connect(self):
         """Anslut till Sub Phatty"""
+        if self.virtual:
+            self.synth = VirtualSubPhatty(channel=self.channel)
+            self.midi_out = self.synth.open_output()
+            print(f"✅ Ansluten till: {self.synth.name}")
+            return True
+        
         try:
             output_ports = mido.get_output_names()
             sub_phatty_port = None
@@ -50,6 +76,14 @@ class PersistentSubPhattyController:
             
             self.midi_out = mido.open_output(sub_phatty_port)
             print(f"✅ Ansluten till: {sub_phatty_port}")
+            
+            # Ingången behövs för att se när något skriver över låsta värden
+            for port in mido.get_input_names():
+                if 'sub phatty' in port.lower() or 'moog' in port.lower():
+                    self.input_name = port
+                    break
+            if not self.input_name:
+                print("⚠️  Ingen MIDI-ingång från Sub Phatty, parametervakten kan inte startas")
             return True
             
         except Exception as e:
@@ -60,41 +94,98 @@ class PersistentSubPhattyController:
         """Skicka MIDI CC-meddelande"""
         if self.midi_out:
             try:
-                msg = mido.Message('control_change', channel=0, control=cc_number, value=value)
-                self.midi_out.send(msg)
+                msg = mido.Message('control_change', channel=self.channel, control=cc_number, value=value)
+                with self.lock:
+                    self.midi_out.send(msg)
                 return True
             except Exception as e:
                 print(f"Fel vid sändning: {e}")
         return False
     
-    def parameter_keeper(self):
-        """Kontinuerligt säkerställ att rätt parametrar är aktiva"""
-        while self.running:
-            # Skicka aktuella värden var 500ms
-            self.send_parameter(self.MODULATION_SOURCE_CC, self.current_mod_source)
-            time.sleep(0.1)
-            self.send_parameter(self.VCO1_OCTAVE_CC, self.current_vco1_octave)
-            time.sleep(0.4)  # Totalt 500ms mellan cykler
+    def pin(self, cc_number, value):
+        """Skicka ett värde och lås det om vakten är på"""
+        with self.lock:
+            if self.running:
+                self.pinned[cc_number] = value
+        self.send_parameter(cc_number, value)
+    
+    def changed_values(self, msg):
+        """(cc, värde) som ett inkommande meddelande sätter, None = okänt (allt kan ha ändrats)"""
+        if msg.type == 'control_change':
+            if msg.channel != self.channel:
+                return []
+            return [(msg.control, msg.value)]
+        if msg.type == 'program_change':
+            # Ny patch från panelen, vilka värden den har syns inte
+            return None
+        if msg.type == 'sysex':
+            data = tuple(msg.data)
+            if data[:3] == SYSEX_HEADER + (SYSEX_PATCH,):
+                values = data[3:]
+                return [(cc, values[PARAMETERS_BY_CC[cc].index]) for cc in self.pinned
+                        if PARAMETERS_BY_CC[cc].index < len(values)]
+            if data[:1] == SYSEX_HEADER[:1]:
+                return None  # Annan Moog-SysEx, formatet är inte känt
+        return []
+    
+    def on_message(self, msg):
+        """Anropas från ingångens tråd, återställer låsta värden som ändrats"""
+        changes = self.changed_values(msg)
+        with self.lock:
+            if changes is None:
+                wrong = dict(self.pinned)
+            else:
+                wrong = {cc: self.pinned[cc] for cc, value in changes
+                         if cc in self.pinned and self.pinned[cc] != value}
+        for cc_number, value in wrong.items():
+            self.corrections += 1
+            print(f"\n🔁 CC {cc_number} ändrades utifrån ({msg.type}), återställer till {value}")
+            self.send_parameter(cc_number, value)
     
     def start_parameter_keeper(self):
-        """Starta kontinuerlig parametersändning"""
-        if not self.running:
+        """Lås aktuella värden och börja lyssna efter ändringar"""
+        if self.running:
+            return
+        if not self.synth and not self.input_name:
+            print("✗ Ingen MIDI-ingång, parametervakten behöver synthens MIDI-ut")
+            return
+        
+        with self.lock:
             self.running = True
-            self.sender_thread = threading.Thread(target=self.parameter_keeper, daemon=True)
-            self.sender_thread.start()
-            print("🔄 Parameterkontroll aktiverad (skickar värden kontinuerligt)")
+            self.pinned = {self.MODULATION_SOURCE_CC: self.current_mod_source,
+                           self.VCO1_OCTAVE_CC: self.current_vco1_octave}
+        try:
+            if self.synth:
+                self.midi_in = self.synth.open_input(callback=self.on_message)
+            else:
+                self.midi_in = mido.open_input(self.input_name, callback=self.on_message)
+        except Exception as e:
+            self.running = False
+            print(f"✗ Kunde inte öppna MIDI-ingången: {e}")
+            return
+        
+        # Skickas en gång, sedan bara när något skriver över dem
+        for cc_number, value in list(self.pinned.items()):
+            self.send_parameter(cc_number, value)
+        print("🔄 Parametervakt aktiverad (återställer låsta värden när de ändras)")
     
     def stop_parameter_keeper(self):
-        """Stoppa kontinuerlig parametersändning"""
-        self.running = False
-        if self.sender_thread:
-            self.sender_thread.join(timeout=1)
-        print("⏹️  Parameterkontroll stoppad")
+        """Sluta lyssna och släpp låsta värden"""
+        if not self.running:
+            return
+        with self.lock:
+            self.running = False
+            self.pinned = {}
+        if self.midi_in:
+            self.midi_in.close()
+            self.midi_in = None
+        print(f"⏹️  Parametervakt stoppad ({self.corrections} återställningar)")
     
     def set_modulation_source(self, index):
         """Sätt modulationskälla"""
         if 0 <= index <= 5:
             self.current_mod_source = self.mod_source_values[index]
+            self.pin(self.MODULATION_SOURCE_CC, self.current_mod_source)
             print(f"✅ Modulation Source: {self.mod_source_names[index]} (CC {self.MODULATION_SOURCE_CC} = {self.current_mod_source})")
             return True
         return False
@@ -103,6 +194,7 @@ class PersistentSubPhattyController:
         """Sätt VCO 1 oktav"""
         if 0 <= index <= 3:
             self.current_vco1_octave = self.vco_octave_values[index]
+            self.pin(self.VCO1_OCTAVE_CC, self.current_vco1_octave)
             print(f"✅ VCO 1 Octave: {self.vco_octave_names[index]} (CC {self.VCO1_OCTAVE_CC} = {self.current_vco1_octave})")
             return True
         return False
@@ -110,7 +202,7 @@ class PersistentSubPhattyController:
     def run_interactive(self):
         """Kör interaktiv loop"""
         print("\n=== Sub Phatty Controller (Persistent version) ===")
-        print("Denna version håller inställningar genom kontinuerlig sändning\n")
+        print("Denna version håller inställningar genom att återställa dem när de ändras\n")
         
         if not self.connect():
             return
@@ -123,8 +215,8 @@ class PersistentSubPhattyController:
         for i, name in enumerate(self.vco_octave_names):
             print(f"  v{i} = {name}")
         print("\nKontroll:")
-        print("  start = Aktivera kontinuerlig parametersändning")
-        print("  stop  = Stoppa kontinuerlig parametersändning") 
+        print("  start = Lås värdena och återställ dem när de ändras")
+        print("  stop  = Stoppa parametervakten")
         print("  q     = Avsluta")
         print()
         
@@ -159,7 +251,7 @@ class PersistentSubPhattyController:
         print("\nMIDI-anslutning stängd")
 
 def main():
-    controller = PersistentSubPhattyController()
+    controller = PersistentSubPhattyController(virtual='--virtual' in sys.argv)
     controller.run_interactive()
 
 if __name__ == "__main__":
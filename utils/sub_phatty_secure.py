@@ -1,14 +1,120 @@
 #!/usr/bin/env python3
 """
 Sub Phatty Controller - Förbättrad sändningsmetod
-Skickar meddelanden flera gånger för att säkerställa att de fastnar
+Bekräftar att meddelanden kommit fram
+
+Varje CC skickas en gång och synthens eko väntas in på ingångsporten.
+Synthen ekar bara ändringar, så ett värde som den senast rapporterade
+räknas som bekräftat direkt. Kommer inget eko inom timeout skickas
+meddelandet igen. Fördröjningen till bekräftelsen mäts per meddelande.
+
+Emulatorn kan också svara med hela patchen på en SysEx-förfrågan. Den
+används bara med --virtual, Sub Phattys eget patchformat är inte känt.
+
+Utan ingångsport används den gamla metoden, tre sändningar med 100 ms
+mellanrum. Med --virtual körs den mot en emulerad Sub Phatty.
 """
 
 import mido
+import os
+import sys
+import threading
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sub_phatty_midi import summarize_latencies
+from sub_phatty_params import PARAMETERS
+from sub_phatty_virtual import SYSEX_HEADER, SYSEX_PATCH, SYSEX_REQUEST, VirtualSubPhatty
+
+# Tid att vänta på eko eller patchsvar, några ms räcker för USB och 31.25 kbaud
+CONFIRM_TIMEOUT = 0.02
+
+class ConfirmedSender:
+    """
+    Skickar CC och väntar på att synthen bekräftar värdet.
+
+    state är synthens värden {cc: värde} så som de senast rapporterats på
+    ingången, uppdateras från ingångens tråd. request_state skickar
+    emulatorns patchförfrågan när ekot uteblir, bara för VirtualSubPhatty.
+    """
+
+    def __init__(self, midi_out, channel=0, timeout=CONFIRM_TIMEOUT, retries=2,
+                 request_state=False):
+        self.midi_out = midi_out
+        self.channel = channel
+        self.timeout = timeout
+        self.retries = retries
+        self.request_state = request_state
+        self.state = {}
+        self.condition = threading.Condition()
+
+        # Statistik
+        self.latencies = []
+        self.confirmed = 0
+        self.resent = 0
+        self.failed = 0
+
+    def on_message(self, msg):
+        """Callback för ingångsporten"""
+        if msg.type == 'control_change' and msg.channel == self.channel:
+            changes = {msg.control: msg.value}
+        elif msg.type == 'sysex' and tuple(msg.data[:3]) == SYSEX_HEADER + (SYSEX_PATCH,):
+            changes = {parameter.cc_msb: value
+                       for parameter, value in zip(PARAMETERS, msg.data[3:])}
+        else:
+            return
+        with self.condition:
+            self.state.update(changes)
+            self.condition.notify_all()
+
+    def _wait_for(self, cc_number, value, deadline):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.state.get(cc_number) == value,
+                                           max(0, deadline - time.perf_counter()))
+
+    def send(self, cc_number, value):
+        """Skicka och vänta på bekräftelse, returnerar fördröjningen i sekunder eller None"""
+        msg = mido.Message('control_change', channel=self.channel, control=cc_number, value=value)
+        start = time.perf_counter()
+        with self.condition:
+            known = self.state.get(cc_number) == value
+        self.midi_out.send(msg)
+        if known:
+            # Synthen har redan värdet och ekar inte samma värde igen
+            return self._confirm(start)
+
+        for attempt in range(1 + self.retries):
+            if attempt:
+                self.resent += 1
+                self.midi_out.send(msg)
+            if self._wait_for(cc_number, value, time.perf_counter() + self.timeout):
+                return self._confirm(start)
+
+            if self.request_state:
+                # Inget eko, värdet kan ha varit satt innan. Fråga efter patchen.
+                self.midi_out.send(mido.Message('sysex', data=SYSEX_HEADER + (SYSEX_REQUEST,)))
+                if self._wait_for(cc_number, value, time.perf_counter() + self.timeout):
+                    return self._confirm(start)
+        self.failed += 1
+        return None
+
+    def _confirm(self, start):
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        self.confirmed += 1
+        return latency
+
+    def summary(self):
+        """Statistik över alla sändningar"""
+        return {
+            'confirmed': self.confirmed,
+            'resent': self.resent,
+            'failed': self.failed,
+            'latency_ms': summarize_latencies(self.latencies)
+        }
+
 def send_parameter_secure(midi_out, cc_number, value, repetitions=3, delay=0.1):
-    """Skicka MIDI-parameter flera gånger för säkerhet"""
+    """Skicka MIDI-parameter flera gånger för säkerhet (när ingen ingångsport finns)"""
     for i in range(repetitions):
         msg = mido.Message('control_change', channel=0, control=cc_number, value=value)
         midi_out.send(msg)
@@ -20,25 +126,44 @@ def main():
     print("=== Sub Phatty Controller (Säker sändning) ===\n")
     
     # Anslut
-    try:
-        output_ports = mido.get_output_names()
-        sub_phatty_port = None
-        
-        for port in output_ports:
-            if 'sub phatty' in port.lower() or 'moog' in port.lower():
-                sub_phatty_port = port
-                break
-        
-        if not sub_phatty_port:
-            print("Ingen Sub Phatty hittad!")
+    midi_in = None
+    if '--virtual' in sys.argv:
+        synth = VirtualSubPhatty(channel=0)
+        midi_out = synth.open_output()
+        sender = ConfirmedSender(midi_out, request_state=True)
+        midi_in = synth.open_input(callback=sender.on_message)
+        print(f"✅ Ansluten till: {synth.name}\n")
+    else:
+        try:
+            output_ports = mido.get_output_names()
+            sub_phatty_port = None
+            
+            for port in output_ports:
+                if 'sub phatty' in port.lower() or 'moog' in port.lower():
+                    sub_phatty_port = port
+                    break
+            
+            if not sub_phatty_port:
+                print("Ingen Sub Phatty hittad!")
+                return
+            
+            midi_out = mido.open_output(sub_phatty_port)
+            print(f"✅ Ansluten till: {sub_phatty_port}")
+            
+            # Ekot från synthen behövs för att bekräfta
+            sender = ConfirmedSender(midi_out)
+            for port in mido.get_input_names():
+                if 'sub phatty' in port.lower() or 'moog' in port.lower():
+                    midi_in = mido.open_input(port, callback=sender.on_message)
+                    break
+            if midi_in:
+                print(f"✅ Lyssnar på: {midi_in.name}\n")
+            else:
+                print("⚠️  Ingen MIDI-ingång, skickar 3x utan bekräftelse\n")
+            
+        except Exception as e:
+            print(f"MIDI-fel: {e}")
             return
-        
-        midi_out = mido.open_output(sub_phatty_port)
-        print(f"✅ Ansluten till: {sub_phatty_port}\n")
-        
-    except Exception as e:
-        print(f"MIDI-fel: {e}")
-        return
     
     # MIDI CC-nummer
     MODULATION_SOURCE_CC = 71
@@ -51,13 +176,27 @@ def main():
     vco_octave_values = [16, 32, 48, 64]
     vco_octave_names = ["16'", "8'", "4'", "2'"]
     
-    print("=== Kommandon (säker sändning - 3x repetition) ===")
+    def send(name, cc_number, value):
+        if not midi_in:
+            print(f"🔄 Skickar {name} (3x repetition)...")
+            send_parameter_secure(midi_out, cc_number, value)
+            print(f"✅ Klart! CC {cc_number} = {value}")
+            return
+        latency = sender.send(cc_number, value)
+        if latency is None:
+            print(f"⚠️  {name}: ingen bekräftelse efter {1 + sender.retries} försök (CC {cc_number} = {value})")
+        else:
+            print(f"✅ {name} bekräftad på {latency * 1000:.1f} ms (CC {cc_number} = {value})")
+    
+    mode = "bekräftad sändning" if midi_in else "säker sändning - 3x repetition"
+    print(f"=== Kommandon ({mode}) ===")
     print("Modulation Source:")
     for i, name in enumerate(mod_source_names):
         print(f"  m{i} = {name}")
     print("\nVCO 1 Octave:")
     for i, name in enumerate(vco_octave_names):
         print(f"  v{i} = {name}")
+    print("  stats = Bekräftelser och fördröjning")
     print("  q = Avsluta")
     print()
     
@@ -67,22 +206,25 @@ def main():
             
             if cmd == 'q':
                 break
+            elif cmd == 'stats':
+                summary = sender.summary()
+                latency = summary['latency_ms']
+                print(f"Bekräftade: {summary['confirmed']}, omsända: {summary['resent']}, "
+                      f"utan bekräftelse: {summary['failed']}")
+                print(f"Fördröjning: p50 {latency['p50']} ms, p99 {latency['p99']} ms, "
+                      f"max {latency['max']} ms")
             elif cmd.startswith('m') and len(cmd) == 2 and cmd[1].isdigit():
                 idx = int(cmd[1])
                 if 0 <= idx <= 5:
-                    value = mod_source_values[idx]
-                    print(f"🔄 Skickar Modulation Source: {mod_source_names[idx]} (3x repetition)...")
-                    send_parameter_secure(midi_out, MODULATION_SOURCE_CC, value)
-                    print(f"✅ Klart! CC {MODULATION_SOURCE_CC} = {value}")
+                    send(f"Modulation Source: {mod_source_names[idx]}",
+                         MODULATION_SOURCE_CC, mod_source_values[idx])
                 else:
                     print("✗ Modulation Source: 0-5")
             elif cmd.startswith('v') and len(cmd) == 2 and cmd[1].isdigit():
                 idx = int(cmd[1])
                 if 0 <= idx <= 3:
-                    value = vco_octave_values[idx]
-                    print(f"🔄 Skickar VCO 1 Octave: {vco_octave_names[idx]} (3x repetition)...")
-                    send_parameter_secure(midi_out, VCO1_OCTAVE_CC, value)
-                    print(f"✅ Klart! CC {VCO1_OCTAVE_CC} = {value}")
+                    send(f"VCO 1 Octave: {vco_octave_names[idx]}",
+                         VCO1_OCTAVE_CC, vco_octave_values[idx])
                 else:
                     print("✗ VCO 1 Octave: 0-3")
             else:
@@ -93,6 +235,8 @@ def main():
         except Exception as e:
             print(f"✗ Fel: {e}")
     
+    if midi_in:
+        midi_in.close()
     midi_out.close()
     print("\nMIDI-anslutning stängd")
 
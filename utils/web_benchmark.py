@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+End-to-end-benchmark för webbcontrollern
+
+Startar sub_phatty_web.py med --virtual i en egen process och låter N
+simulerade webbläsare dra i LFO rate-slidern (WebSocket, som sidan gör,
+eller HTTP som reservvägen) och då och då trycka på en knapp. Resultatet
+skrivs som JSON så att versioner kan jämföras:
+
+    python3 utils/web_benchmark.py --clients 8 --duration 10 > före.json
+
+http_latency_ms   tid för HTTP-förfrågningar, mätt hos klienten
+midi_latency_ms   från att ändringen kom in till servern tills den skrivits
+                  till MIDI-porten (från serverns /stats)
+server_cpu        serverprocessens CPU-tid under körningen
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from sub_phatty_midi import summarize_latencies
+
+# Knappar som trycks, som på sidan
+BUTTONS = [('lfo', 'Triangle'), ('lfo', 'Square'), ('lfo', 'Saw'), ('lfo', 'Ramp'),
+           ('vco', "16'"), ('vco', "8'"), ('vco', "4'"), ('vco', "2'")]
+
+def free_port():
+    """En ledig TCP-port på localhost"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def get_json(port, path, timeout=5):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        connection.request('GET', path)
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+def start_server(args, port):
+    """Starta servern mot en virtuell Sub Phatty och vänta tills den är ansluten"""
+    # Varje klient håller en arbetare för keep-alive, WebSocket-strömmen
+    # räknas mot --max-streams
+    command = [sys.executable, os.path.join(ROOT, 'sub_phatty_web.py'), '--virtual',
+               '--no-browser', '--port', str(port),
+               '--workers', str(max(32, args.clients + 8)),
+               '--max-streams', str(max(64, 2 * args.clients)),
+               '--coalesce-ms', str(args.coalesce_ms)]
+    output = None if args.server_output else subprocess.DEVNULL
+    server = subprocess.Popen(command, cwd=ROOT, stdout=output, stderr=output)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"✗ Servern avslutades med kod {server.returncode}")
+        try:
+            if get_json(port, '/status', timeout=1)['connected']:
+                return server
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.1)
+    stop_server(server)
+    raise SystemExit("✗ Servern startade inte inom 10 s")
+
+def stop_server(server):
+    """Som Ctrl+C, så att servern stänger sina trådar"""
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+class WebSocketClient:
+    """Minimal WebSocket-klient (RFC 6455), klientramar måste maskas"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f"GET /ws HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+                           f"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                           f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n")
+                          .encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            chunk = self.sock.recv(1024)
+            if not chunk:
+                raise ConnectionError("WebSocket-handskakningen avbröts")
+            response += chunk
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise ConnectionError(response.split(b'\r\n', 1)[0].decode())
+        self.sock.settimeout(None)
+
+        # Servern skickar andra klienters ändringar hit, de måste läsas
+        # annars blir dess skrivningar till slut blockerade
+        self.received = 0
+        self.errors = 0
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def send(self, text):
+        payload = text.encode()
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.sock.sendall(struct.pack('!BB', 0x81, 0x80 | len(payload)) + mask + masked)
+
+    def _read(self):
+        stream = self.sock.makefile('rb')
+        try:
+            while True:
+                header = stream.read(2)
+                if len(header) < 2:
+                    return
+                length = header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('!H', stream.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', stream.read(8))[0]
+                payload = stream.read(length)
+                if payload.startswith(b'error='):
+                    self.errors += 1
+                else:
+                    self.received += 1
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            self.sock.sendall(struct.pack('!BB', 0x88, 0x80) + os.urandom(4))
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class SimulatedClient(threading.Thread):
+    """En webbläsare: slider-värden i jämn takt och en knapp ibland"""
+
+    def __init__(self, number, port, transport, slider_rate, button_interval, stop):
+        super().__init__(name=f"client-{number}", daemon=True)
+        self.port = port
+        self.transport = transport
+        self.period = 1.0 / slider_rate
+        self.button_interval = button_interval
+        self.stop = stop
+        self.random = random.Random(number)
+
+        # Resultat
+        self.sliders = 0
+        self.buttons = 0
+        self.errors = 0
+        self.http_latencies = []
+
+    def http_get(self, connection, path):
+        """En förfrågan på keep-alive-anslutningen, mäter tiden"""
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+            ok = response.status == 200 and b'"success": true' in body
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            ok = False
+        self.http_latencies.append(time.perf_counter() - start)
+        if not ok:
+            self.errors += 1
+
+    def run(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        websocket = WebSocketClient(self.port) if self.transport == 'ws' else None
+
+        # Slidern dras fram och tillbaka med lite olika fart per klient
+        position = self.random.uniform(0, 127)
+        speed = self.random.uniform(1, 4)
+        next_slider = time.monotonic()
+        next_button = next_slider + self.random.uniform(0, self.button_interval)
+        try:
+            while not self.stop.is_set():
+                now = time.monotonic()
+                if now >= next_button:
+                    command, value = self.random.choice(BUTTONS)
+                    self.http_get(connection, f"/{command}?param={urllib.parse.quote(value)}")
+                    self.buttons += 1
+                    next_button += self.button_interval
+
+                position += speed
+                if position > 127 or position < 0:
+                    speed = -speed
+                    position = min(127, max(0, position))
+                value = int(position)
+                if websocket:
+                    websocket.send(f"lfo_rate={value}")
+                else:
+                    self.http_get(connection, f"/lfo_rate?param={value}")
+                self.sliders += 1
+
+                # Jämn takt mot deadlines, som en webbläsares input-händelser
+                next_slider += self.period
+                delay = next_slider - time.monotonic()
+                if delay > 0:
+                    self.stop.wait(delay)
+                else:
+                    next_slider = time.monotonic()
+        finally:
+            if websocket:
+                self.errors += websocket.errors
+                websocket.close()
+            connection.close()
+
+def difference(after, before, key):
+    return after[key] - before[key]
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    port = free_port()
+    server = start_server(args, port)
+    try:
+        before = get_json(port, '/stats?reset=1')
+
+        stop = threading.Event()
+        clients = []
+        for number in range(args.clients):
+            transport = args.transport
+            if transport == 'mixed':
+                transport = 'ws' if number % 2 == 0 else 'http'
+            clients.append(SimulatedClient(number, port, transport, args.slider_rate,
+                                           args.button_interval, stop))
+
+        print(f"Kör {args.clients} klienter i {args.duration} s...", file=sys.stderr)
+        start = time.monotonic()
+        for client in clients:
+            client.start()
+        time.sleep(args.duration)
+        stop.set()
+        for client in clients:
+            client.join()
+        elapsed = time.monotonic() - start
+
+        # Låt köerna tömmas innan räknarna läses
+        time.sleep(args.drain)
+        after = get_json(port, '/stats')
+    finally:
+        stop_server(server)
+
+    device = next(iter(after['devices']))
+    device_before, device_after = before['devices'][device], after['devices'][device]
+    events = sum(client.sliders + client.buttons for client in clients)
+    messages = difference(device_after, device_before, 'sent')
+    client_errors = sum(client.errors for client in clients)
+    server_errors = difference(device_after, device_before, 'errors')
+    cpu = (difference(after['cpu'], before['cpu'], 'user') +
+           difference(after['cpu'], before['cpu'], 'system'))
+    wire_bytes = difference(device_after['virtual'], device_before['virtual'], 'bytes')
+
+    return {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'config': {
+            'clients': args.clients,
+            'transport': args.transport,
+            'duration': args.duration,
+            'slider_rate': args.slider_rate,
+            'button_interval': args.button_interval,
+            'coalesce_ms': args.coalesce_ms
+        },
+        'elapsed': round(elapsed, 3),
+        'events': events,
+        'events_per_second': round(events / elapsed, 1),
+        'slider_events': sum(client.sliders for client in clients),
+        'button_events': sum(client.buttons for client in clients),
+        'midi_messages': messages,
+        'messages_per_second': round(messages / elapsed, 1),
+        'coalesced': difference(device_after, device_before, 'coalesced'),
+        'suppressed': difference(device_after, device_before, 'suppressed'),
+        'dropped': client_errors + server_errors,
+        'http_latency_ms': summarize_latencies(
+            [sample for client in clients for sample in client.http_latencies]),
+        'midi_latency_ms': device_after['latency_ms'],
+        'wire_utilization': round(wire_bytes * 10 / 31250 / elapsed, 3),
+        'server_cpu': {
+            'seconds': round(cpu, 3),
+            'percent': round(100 * cpu / elapsed, 1)
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end-benchmark för sub_phatty_web.py")
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Antal simulerade webbläsare (standard: 8)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Sekunder att köra (standard: 10)')
+    parser.add_argument('--transport', choices=['ws', 'http', 'mixed'], default='mixed',
+                        help='Slider via WebSocket, HTTP eller varannan (standard: mixed)')
+    parser.add_argument('--slider-rate', type=float, default=60,
+                        help='Slider-händelser per sekund och klient (standard: 60)')
+    parser.add_argument('--button-interval', type=float, default=2.0,
+                        help='Sekunder mellan knapptryck per klient (standard: 2)')
+    parser.add_argument('--coalesce-ms', type=float, default=20,
+                        help='Serverns --coalesce-ms (standard: 20)')
+    parser.add_argument('--drain', type=float, default=0.5,
+                        help='Sekunder att vänta på serverns köer efter körningen (standard: 0.5)')
+    parser.add_argument('--output', help='Skriv JSON till en fil i stället för stdout')
+    parser.add_argument('--server-output', action='store_true',
+                        help='Visa serverns utskrifter')
+    args = parser.parse_args()
+
+    result = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()